@@ -0,0 +1,30 @@
+import traceback
+
+from app import DatabaseManager
+from config import config
+from fastapi import APIRouter, HTTPException, status
+from fastapi.logger import logger
+from fastapi.param_functions import Depends
+from pymongo.errors import PyMongoError
+
+from api.security import get_current_admin_user
+from api.users.schemas import Principal
+
+router = APIRouter()
+
+
+@router.get("/query-plans")
+async def get_query_plans(current_user: Principal = Depends(get_current_admin_user)):
+    """explain every database manager query and flag collection scans"""
+    try:
+        queries = await DatabaseManager.explain_queries(config.MONGODB_DB)
+        return {
+            "collscans": [f"{q['manager']}.{q['query']}" for q in queries if q["collscan"]],
+            "queries": queries,
+        }
+    except PyMongoError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="query plan report failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
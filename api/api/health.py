@@ -1,15 +1,63 @@
-from app import CacheManager, DatabaseManager
-from fastapi import APIRouter
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from app import CacheManager, CryptoExecutor, DatabaseManager
+from config import config
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
 
 router = APIRouter()
 
 
+class Probe:
+    """
+    dependency check run at most once per interval, with its own timeout. concurrent callers share the running
+    check and its result, so health polling costs one round trip per dependency & interval per worker
+    """
+
+    def __init__(self, check: Callable[[float], Awaitable[bool]], interval: float, timeout: float) -> None:
+        self.check = check
+        self.interval = interval
+        self.timeout = timeout
+
+        self._result = None
+        self._checked = 0.0
+        self._running = None
+
+    async def result(self) -> dict:
+        if self._result is None or time.monotonic() - self._checked >= self.interval:
+            if self._running is None:
+                self._running = asyncio.ensure_future(self._run())
+                self._running.add_done_callback(self._done)
+            # shielded, so a caller going away doesn't cancel the check for the others
+            await asyncio.shield(self._running)
+
+        return dict(self._result, age_s=round(time.monotonic() - self._checked, 3))
+
+    async def _run(self):
+        started = time.perf_counter()
+        try:
+            up = await self.check(self.timeout)
+        except Exception:
+            up = False
+        self._result = {"up": up, "latency_ms": round((time.perf_counter() - started) * 1000, 3)}
+        self._checked = time.monotonic()
+
+    def _done(self, _):
+        self._running = None
+
+
+mongodb_probe = Probe(DatabaseManager.ping, interval=config.HEALTH_PROBE_INTERVAL, timeout=config.HEALTH_PROBE_TIMEOUT)
+redis_probe = Probe(CacheManager.ping, interval=config.HEALTH_PROBE_INTERVAL, timeout=config.HEALTH_PROBE_TIMEOUT)
+
+
 @router.get("")
 async def get_health():
     """show app health"""
 
-    redis_health = await CacheManager.ping()
-    mongodb_health = DatabaseManager.ping()
+    mongodb, redis = await asyncio.gather(mongodb_probe.result(), redis_probe.result())
+    redis_health, mongodb_health = redis["up"], mongodb["up"]
 
     status = "RED"
     if mongodb_health:
@@ -23,3 +71,37 @@ async def get_health():
         "redis": "Up" if redis_health else "Down",
         "mongodb": "Up" if mongodb_health else "Down",
     }
+
+
+@router.get("/live")
+async def get_liveness():
+    """liveness: the worker's event loop is serving requests. checks no dependency"""
+
+    return {"status": "live"}
+
+
+@router.get("/ready")
+async def get_readiness():
+    """readiness: the database is reachable (the cache is optional, the api runs without it). 503 otherwise"""
+
+    mongodb, redis = await asyncio.gather(mongodb_probe.result(), redis_probe.result())
+    ready = mongodb["up"]
+
+    return JSONResponse(
+        content={"status": "ready" if ready else "not ready", "mongodb": mongodb, "redis": redis},
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+@router.get("/crypto")
+async def get_crypto_executor_stats():
+    """show crypto executor queue depth & wait time"""
+
+    return CryptoExecutor.stats()
+
+
+@router.get("/cache")
+async def get_cache_stats():
+    """show per-worker l1 cache hit/miss/eviction counters"""
+
+    return CacheManager.stats()
@@ -1,5 +1,3 @@
-import asyncio
-
 from app import DatabaseManager
 from bson.objectid import ObjectId
 from config import config
@@ -8,11 +6,12 @@ from config import config
 class AuthDBManager(DatabaseManager):
     """database manager for login route"""
 
-    def __init__(self) -> None:
-        DatabaseManager._client.get_io_loop = asyncio.get_running_loop
-
-        self.db = DatabaseManager._client[config.MONGODB_DB]
-        self.collection = self.db[config.MONGODB_COLLECTION_USERS]
+    # indexes on the users collection are declared by UserDBManager
+    db_name = config.MONGODB_DB
+    collection_name = config.MONGODB_COLLECTION_USERS
+    queries = {
+        "get_user_by_email": ({"email": ""}, None),
+    }
 
     def _to_dict(self, record: dict) -> dict:
         record["_id"] = str(record["_id"])
@@ -6,7 +6,7 @@ from fastapi.logger import logger
 from fastapi.param_functions import Depends
 from fastapi.security import OAuth2PasswordRequestForm
 
-from api.security import check_pw_hash, create_access_token, decrypt_dek
+from api.security import check_pw_hash_async, create_access_token, decrypt_dek_async
 
 from .db import AuthDBManager
 
@@ -28,11 +28,11 @@ async def login_user(
         if not user.get("is_active"):
             raise HTTPException(detail="inactive user", status_code=status.HTTP_400_BAD_REQUEST)
 
-        if not check_pw_hash(payload.password, user.get("hashed_password")):
+        if not await check_pw_hash_async(payload.password, user.get("hashed_password")):
             raise HTTPException(detail="invalid credentials", status_code=status.HTTP_400_BAD_REQUEST)
 
         access_token = create_access_token(data={"_id": user.get("_id")})
-        dek = decrypt_dek(payload.password, user.get("salt"), user.get("encrypted_dek"))
+        dek = await decrypt_dek_async(payload.password, user.get("salt"), user.get("encrypted_dek"))
 
         response.set_cookie(
             key="dek",
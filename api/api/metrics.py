@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Response
+from telemetry import render_metrics
+
+router = APIRouter()
+
+
+@router.get("", include_in_schema=False)
+async def get_metrics():
+    """prometheus metrics, aggregated across all gunicorn workers"""
+
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
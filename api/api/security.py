@@ -6,8 +6,11 @@ from hashlib import sha256
 from typing import Any
 
 import bcrypt
+from app import CacheManager
 from config import config
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet
+from db.cache import LocalCache
+from executor import CryptoExecutor, CryptoExecutorBusy
 from fastapi import HTTPException, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.logger import logger
@@ -18,7 +21,7 @@ from pydantic import BaseModel, ValidationError
 from pydantic.fields import Field
 
 from .users.db import UserDBManager
-from .users.schemas import UpdateUserDEK, UserInDB
+from .users.schemas import Principal, UpdateUserDEK
 
 SECRET_KEY = config.SECRET_KEY
 ALGORITHM = "HS256"
@@ -32,6 +35,21 @@ class JWTTokenData(BaseModel):
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="login")
 db = UserDBManager()
 
+# authenticated users are cached per worker (as models) and in redis (as compact dicts)
+principals = LocalCache(
+    max_items=config.PRINCIPAL_CACHE_MAX_ITEMS,
+    max_bytes=config.PRINCIPAL_CACHE_MAX_ITEMS * 1024,
+    timeout=config.PRINCIPAL_CACHE_L1_TIMEOUT,
+)
+CacheManager.register_local_cache(principals)
+
+# fernet ciphers keyed by a hash of their dek, so key setup is paid once per dek rather than per payload
+ciphers = LocalCache(
+    max_items=config.CIPHER_CACHE_MAX_ITEMS,
+    max_bytes=config.CIPHER_CACHE_MAX_ITEMS,
+    timeout=config.CIPHER_CACHE_TIMEOUT,
+)
+
 # jwt
 def create_access_token(data: dict, expiry_minutes: int = ACCESS_TOKEN_EXPIRE_TIMEOUT) -> str:
     to_encode = data.copy()
@@ -56,20 +74,48 @@ def verify_access_token(token: str) -> dict:
 
 
 # user scope
-async def get_current_user(token: str = Depends(oauth2_schema)) -> UserInDB:
+def _principal_key(id: str) -> str:
+    return f"(principal)({id})"
+
+
+def _to_principal(user: dict) -> dict:
+    # only what authorization & the user's own responses need. the password hash, salt & wrapped dek stay in the
+    # database, the flows using them read them from there
+    return jsonable_encoder({field.alias: user.get(field.alias) for field in Principal.__fields__.values()})
+
+
+async def invalidate_principal(id: str):
+    await CacheManager.delete(_principal_key(id))
+
+
+async def get_current_user(token: str = Depends(oauth2_schema)) -> Principal:
     token_data = verify_access_token(token)
-    user = await db.get_user_by_id(token_data.id)
-    if not user:
-        raise HTTPException(
-            detail="user not found",
-            status_code=status.HTTP_404_NOT_FOUND,
-        )
-    return UserInDB(**user)
+    key = _principal_key(token_data.id)
+
+    user = principals.get(key)
+    if user is not None:
+        return user
+
+    principal = await CacheManager.fetch(key)
+    if not principal:
+        record = await db.get_user_by_id(token_data.id)
+        if not record:
+            raise HTTPException(
+                detail="user not found",
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+
+        principal = _to_principal(record)
+        await CacheManager.store(key, principal, config.PRINCIPAL_CACHE_TIMEOUT, invalidate=False)
+
+    user = Principal(**principal)
+    principals.set(key, user, len(json.dumps(principal)))
+    return user
 
 
 async def get_current_active_user(
-    current_user: UserInDB = Depends(get_current_user),
-) -> UserInDB:
+    current_user: Principal = Depends(get_current_user),
+) -> Principal:
     if not current_user.is_active:
         raise HTTPException(
             detail="inactive user",
@@ -79,8 +125,8 @@ async def get_current_active_user(
 
 
 async def get_current_admin_user(
-    current_user: UserInDB = Depends(get_current_active_user),
-) -> UserInDB:
+    current_user: Principal = Depends(get_current_active_user),
+) -> Principal:
     if not current_user.is_admin:
         raise HTTPException(
             detail="user doesn't have enough privilages",
@@ -134,27 +180,57 @@ def decrypt_dek(password: str, salt: str, encrypted_dek: str) -> str:
     return decrypted_dek
 
 
+# async wrappers, run the cpu heavy functions above in the crypto process pool
+async def _run_crypto(func, *args, exempt: bool = False) -> Any:
+    try:
+        return await CryptoExecutor.run(func, *args, exempt=exempt)
+    except CryptoExecutorBusy:
+        raise HTTPException(
+            detail="server busy, try again later",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "1"},
+        )
+
+
+async def hash_pw_async(password: str) -> str:
+    return await _run_crypto(hash_pw, password)
+
+
+async def check_pw_hash_async(password: str, pw_hash: str) -> bool:
+    return await _run_crypto(check_pw_hash, password, pw_hash)
+
+
+async def generate_encrypted_dek_async(
+    password: str, salt: str = None, dek: str = None, wrapping_key: str = None
+) -> set:
+    return await _run_crypto(generate_encrypted_dek, password, salt, dek, wrapping_key)
+
+
+async def decrypt_dek_async(password: str, salt: str, encrypted_dek: str) -> str:
+    return await _run_crypto(decrypt_dek, password, salt, encrypted_dek)
+
+
 async def update_user_with_salt_dek(id: str, password: str):
-    salt, encrypted_dek = generate_encrypted_dek(password)
+    # runs after the new user got its response, nobody could retry a rejection & the user would be left without a
+    # dek. so it's exempt from the crypto queue's limits
+    salt, encrypted_dek = await _run_crypto(generate_encrypted_dek, password, None, None, None, exempt=True)
 
     try:
         _ = await db.update_user(id, jsonable_encoder(UpdateUserDEK(salt=salt, encrypted_dek=encrypted_dek)))
+        await invalidate_principal(id)
     except Exception:
         logger.error(traceback.print_exc())
         raise RuntimeError(f"unable to update user with salt and dek: {id}")
 
 
-def encrypt_payload(dek: str, data: Any) -> str:
-    f = Fernet(dek)
-    return f.encrypt(json.dumps(data).encode("utf-8")).decode("utf-8")
-
-
-def decrypt_payload(dek: str, data: str) -> Any:
-    try:
-        f = Fernet(dek)
-        if isinstance(data, dict):
-            return data
-
-        return json.loads(f.decrypt(data.encode("utf-8")))
-    except (ValueError, InvalidToken):
-        return None
+def get_cipher(dek: str) -> Fernet:
+    """fernet cipher for a dek, set up once per dek and kept in memory only. raises ValueError for invalid deks"""
+    key = sha256(dek.encode("utf-8")).digest() if isinstance(dek, str) else None
+    cipher = ciphers.get(key) if key else None
+    if cipher is None:
+        try:
+            cipher = Fernet(dek)
+        except (TypeError, ValueError):
+            raise ValueError("invalid data encryption key")
+        ciphers.set(key, cipher, 1)
+    return cipher
@@ -0,0 +1,42 @@
+from typing import Any, Callable, Type
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+from pydantic.utils import lenient_issubclass
+
+
+def compile_serializer(model: Type[BaseModel]) -> Callable[[dict], dict]:
+    """
+    build a function turning a stored document into the json-ready dict `jsonable_encoder(model(**doc))` would give.
+    stored documents were validated on write, so on read only the schema's fields are picked (by alias), missing
+    ones defaulted and nested models recursed into; values are passed through as is.
+    """
+    fields = []
+    for field in model.__fields__.values():
+        default = None if field.default_factory is not None else field.default
+
+        converter = None
+        if lenient_issubclass(field.type_, BaseModel):
+            nested = compile_serializer(field.type_)
+            if field.shape == SHAPE_SINGLETON:
+                converter = nested
+            elif field.shape == SHAPE_LIST:
+                converter = lambda items, nested=nested: [nested(item) for item in items]
+
+        fields.append((field.alias, default, converter))
+
+    def serialize(document: dict) -> dict:
+        serialized = {}
+        for key, default, converter in fields:
+            value = document.get(key, default)
+            if value is not None and converter is not None:
+                value = converter(value)
+            serialized[key] = value
+        return serialized
+
+    serialize.__name__ = f"serialize_{model.__name__}"
+    return serialize
+
+
+def serialize_many(serializer: Callable[[dict], dict], documents: list) -> Any:
+    return [serializer(document) for document in documents]
@@ -0,0 +1,152 @@
+"""
+blind indexes, so tasks can be filtered on encrypted fields by the database.
+
+status & priority are stored as a keyed hmac of their value, due dates as hmacs of their year, month & day, and
+title, topic & description as the hmacs of their normalized keywords. the hmac key is derived from the user's dek
+with hkdf, so without it the tokens reveal only which of a user's tasks share a value, a due date bucket or a word.
+filters & searches are turned into the tokens they match & answered by the indexes on them.
+"""
+import hmac
+import re
+import unicodedata
+from base64 import urlsafe_b64decode
+from datetime import date, datetime
+from hashlib import sha256
+from typing import Dict, List, Optional
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from api.security import ciphers, get_cipher
+
+INDEXED_FIELDS = ("status", "priority", "due")
+
+# searchable fields, by the weight of a keyword found in them when ranking results
+KEYWORD_FIELDS = {"title": 3, "topic": 2, "description": 1}
+KEYWORD_MIN_LENGTH = 2
+KEYWORD_MAX_PER_FIELD = 256
+
+# "due before" matches the buckets of every day, month & year before a date, years from this one on
+DUE_FIRST_YEAR = 2000
+
+
+def get_index_key(dek: str) -> bytes:
+    """hmac key for a dek's blind index tokens, cached with its ciphers. raises ValueError for invalid deks"""
+    key = b"blind_index" + sha256(dek.encode("utf-8")).digest() if isinstance(dek, str) else None
+    index_key = ciphers.get(key) if key else None
+    if index_key is None:
+        _ = get_cipher(dek)
+        index_key = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=b"jiroapi-task-blind-index-v1"
+        ).derive(urlsafe_b64decode(dek.encode("utf-8")))
+        ciphers.set(key, index_key, 1)
+    return index_key
+
+
+def _token(index_key: bytes, field: str, value: str) -> str:
+    return hmac.new(index_key, f"{field}:{value}".encode("utf-8"), sha256).hexdigest()[:32]
+
+
+def _due_date(due: str) -> date:
+    return datetime.fromisoformat(due).date()
+
+
+def _due_buckets(day: date) -> List[str]:
+    return [f"{day.year:04d}", f"{day.year:04d}-{day.month:02d}", day.isoformat()]
+
+
+def _tokens(index_key: bytes, field: str, value: str):
+    if field == "due":
+        day = _due_date(value)
+        return [_token(index_key, field, bucket) for bucket in _due_buckets(day)]
+    return _token(index_key, field, value)
+
+
+def keywords(text: str) -> List[str]:
+    """distinct words of a text, case & accent folded, in order of appearance"""
+    folded = unicodedata.normalize("NFKD", text.casefold())
+    folded = "".join(char for char in folded if not unicodedata.combining(char))
+    words = dict.fromkeys(word for word in re.findall(r"\w+", folded) if len(word) >= KEYWORD_MIN_LENGTH)
+    return list(words)[:KEYWORD_MAX_PER_FIELD]
+
+
+def _keyword_tokens(index_key: bytes, text: str) -> List[str]:
+    # the same word gives the same token in every field, a search computes its tokens once
+    return [_token(index_key, "keyword", word) for word in keywords(text)]
+
+
+def index_fields(index_key: bytes, task_data: dict) -> dict:
+    """blind index of a task's data"""
+    index = {
+        field: _tokens(index_key, field, task_data[field])
+        for field in INDEXED_FIELDS
+        if task_data.get(field) is not None
+    }
+    index["keywords"] = {
+        field: _keyword_tokens(index_key, task_data[field])
+        for field in KEYWORD_FIELDS
+        if task_data.get(field) is not None
+    }
+    return index
+
+
+def index_update(index_key: bytes, changes: dict) -> dict:
+    """$set of the blind index entries of the indexed fields a partial task_data changes"""
+    update = {
+        f"blind_index.{field}": _tokens(index_key, field, changes[field])
+        for field in INDEXED_FIELDS
+        if changes.get(field) is not None
+    }
+    for field in KEYWORD_FIELDS:
+        if changes.get(field) is not None:
+            update[f"blind_index.keywords.{field}"] = _keyword_tokens(index_key, changes[field])
+    return update
+
+
+def index_query(dek: str, statuses: List[str], priorities: List[str], due_before: Optional[date]) -> dict:
+    """query on the blind index matching the filters. raises ValueError for invalid deks"""
+    index_key = get_index_key(dek)
+    query = {}
+    if statuses:
+        query["blind_index.status"] = {"$in": [_token(index_key, "status", value) for value in statuses]}
+    if priorities:
+        query["blind_index.priority"] = {"$in": [_token(index_key, "priority", value) for value in priorities]}
+    if due_before:
+        buckets = [f"{year:04d}" for year in range(DUE_FIRST_YEAR, due_before.year)]
+        buckets += [f"{due_before.year:04d}-{month:02d}" for month in range(1, due_before.month)]
+        buckets += [due_before.replace(day=day).isoformat() for day in range(1, due_before.day)]
+        query["blind_index.due"] = {"$in": [_token(index_key, "due", bucket) for bucket in buckets]}
+    return query
+
+
+def matches(task_data: dict, statuses: List[str], priorities: List[str], due_before: Optional[date]) -> bool:
+    """the same filters on decrypted task data, for tasks not indexed yet"""
+    if statuses and task_data.get("status") not in statuses:
+        return False
+    if priorities and task_data.get("priority") not in priorities:
+        return False
+    if due_before:
+        return task_data.get("due") is not None and _due_date(task_data["due"]) < due_before
+    return True
+
+
+def search_tokens(dek: str, query: str) -> List[str]:
+    """tokens of a search's keywords. raises ValueError for invalid deks"""
+    return _keyword_tokens(get_index_key(dek), query)
+
+
+def rank(tokens: List[str], index: Dict[str, List[str]]) -> int:
+    """
+    score of a task for a search, from the keyword tokens of its fields: each searched keyword it has counts with
+    the weight of the best field it's in. 0 if it has none
+    """
+    found = {field: set(index.get(field) or []) for field in KEYWORD_FIELDS}
+    return sum(
+        max((weight for field, weight in KEYWORD_FIELDS.items() if token in found[field]), default=0)
+        for token in tokens
+    )
+
+
+def keyword_index(dek: str, task_data: dict) -> Dict[str, List[str]]:
+    """keyword tokens of decrypted task data, to rank tasks not indexed yet. raises ValueError for invalid deks"""
+    return index_fields(get_index_key(dek), task_data)["keywords"]
@@ -0,0 +1,18 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+
+def encode_cursor(last_id: str) -> str:
+    """opaque pagination token built from the last _id of a page"""
+    return urlsafe_b64encode(ObjectId(last_id).binary).decode("utf-8").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return str(ObjectId(urlsafe_b64decode(padded.encode("utf-8"))))
+    except (BinasciiError, InvalidId, TypeError, ValueError):
+        raise ValueError(f"invalid cursor: {cursor}")
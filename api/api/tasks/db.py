@@ -1,19 +1,75 @@
-import asyncio
-from typing import List
+from typing import AsyncIterator, Dict, List, Tuple
 
 from app import DatabaseManager
 from bson.objectid import ObjectId
 from config import config
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
 
 class TaskDBManager(DatabaseManager):
     """database manager for task route"""
 
-    def __init__(self) -> None:
-        DatabaseManager._client.get_io_loop = asyncio.get_running_loop
-
-        self.db = DatabaseManager._client[config.MONGODB_DB]
-        self.collection = self.db[config.MONGODB_COLLECTION_TASKS]
+    db_name = config.MONGODB_DB
+    collection_name = config.MONGODB_COLLECTION_TASKS
+    indexes = [
+        IndexModel([("created_by", ASCENDING), ("_id", ASCENDING)], name="created_by_1__id_1"),
+        # filters on the blind index, & the tasks in an older layout (not indexed yet) a filter also has to look at
+        IndexModel(
+            [("created_by", ASCENDING), ("blind_index.status", ASCENDING), ("_id", ASCENDING)],
+            name="created_by_1_blind_index.status_1__id_1",
+        ),
+        IndexModel(
+            [("created_by", ASCENDING), ("blind_index.priority", ASCENDING), ("_id", ASCENDING)],
+            name="created_by_1_blind_index.priority_1__id_1",
+        ),
+        IndexModel(
+            [("created_by", ASCENDING), ("blind_index.due", ASCENDING), ("_id", ASCENDING)],
+            name="created_by_1_blind_index.due_1__id_1",
+        ),
+        IndexModel(
+            [("created_by", ASCENDING), ("layout", ASCENDING), ("_id", ASCENDING)],
+            name="created_by_1_layout_1__id_1",
+        ),
+        # keyword search, multikey over each searchable field's tokens (one array per index)
+        *[
+            IndexModel(
+                [("created_by", ASCENDING), (f"blind_index.keywords.{field}", ASCENDING)],
+                name=f"created_by_1_blind_index.keywords.{field}_1",
+            )
+            for field in ("title", "topic", "description")
+        ],
+    ]
+    queries = {
+        "get_task_by_id": ({"_id": ObjectId()}, None),
+        "get_tasks_by_created_by": ({"created_by": ""}, [("_id", ASCENDING)]),
+        "get_tasks_by_created_by_after": ({"created_by": "", "_id": {"$gt": ObjectId()}}, [("_id", ASCENDING)]),
+        "get_tasks_by_ids": ({"_id": {"$in": [ObjectId()]}}, None),
+        "get_tasks_by_created_by_status": (
+            {"created_by": "", "$or": [{"blind_index.status": {"$in": [""]}}, {"layout": {"$in": [None, 2, 3]}}]},
+            [("_id", ASCENDING)],
+        ),
+        "get_tasks_by_created_by_priority": (
+            {"created_by": "", "$or": [{"blind_index.priority": {"$in": [""]}}, {"layout": {"$in": [None, 2, 3]}}]},
+            [("_id", ASCENDING)],
+        ),
+        "get_tasks_by_created_by_due": (
+            {"created_by": "", "$or": [{"blind_index.due": {"$in": [""]}}, {"layout": {"$in": [None, 2, 3]}}]},
+            [("_id", ASCENDING)],
+        ),
+        "search_tasks": (
+            {
+                "created_by": "",
+                "$or": [
+                    {"blind_index.keywords.title": {"$in": [""]}},
+                    {"blind_index.keywords.topic": {"$in": [""]}},
+                    {"blind_index.keywords.description": {"$in": [""]}},
+                    {"layout": {"$in": [None, 2, 3]}},
+                ],
+            },
+            None,
+        ),
+    }
 
     def _to_dict(self, record) -> dict:
         record["_id"] = str(record["_id"])
@@ -23,55 +79,147 @@ class TaskDBManager(DatabaseManager):
         task = await self.collection.find_one({"_id": ObjectId(id)})
         return self._to_dict(task) if task else {}
 
-    async def get_tasks_by_created_by(self, created_by: str, skip: int, limit: int) -> List:
-        tasks = [
-            self._to_dict(task)
-            async for task in self.collection.find({"created_by": created_by})
-            .sort([("_id", 1)])
-            .skip(skip)
-            .limit(limit)
-        ]
+    async def get_tasks_by_created_by(
+        self, created_by: str, skip: int, limit: int, after: str = None, filters: dict = None
+    ) -> List:
+        # keyset pagination when a cursor is given (index seek on created_by, _id), offset otherwise
+        query = {"created_by": created_by, **(filters or {})}
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+            skip = 0
+
+        cursor = self.collection.find(query).sort([("_id", 1)])
+        if skip:
+            cursor = cursor.skip(skip)
+
+        tasks = [self._to_dict(task) async for task in cursor.limit(limit)]
         return tasks if tasks else []
 
+    async def iter_tasks_by_created_by(self, created_by: str, batch_size: int) -> AsyncIterator[dict]:
+        """stream every task of a user, fetching `batch_size` documents per round trip"""
+        cursor = self.collection.find({"created_by": created_by}).sort([("_id", 1)]).batch_size(batch_size)
+        async for task in cursor:
+            yield self._to_dict(task)
+
+    async def search_tasks(self, created_by: str, fields: List[str], tokens: List[str], old_layouts: list, limit: int):
+        """
+        ids, layouts & keyword tokens of a user's tasks having any of `tokens` in one of `fields`, plus the ones in
+        `old_layouts` (without keyword tokens yet). at most `limit`, oldest first
+        """
+        query = {
+            "created_by": created_by,
+            "$or": [{f"blind_index.keywords.{field}": {"$in": tokens}} for field in fields]
+            + [{"layout": {"$in": old_layouts}}],
+        }
+        projection = {"blind_index.keywords": 1, "layout": 1}
+        cursor = self.collection.find(query, projection).sort([("_id", 1)]).limit(limit)
+        return [self._to_dict(task) async for task in cursor]
+
     async def add_task(self, task: dict) -> dict:
         inserted = await self.collection.insert_one(task)
         if inserted.acknowledged:
-            task = await self.collection.find_one({"_id": inserted.inserted_id})
-            if task:
-                return self._to_dict(task)
-            else:
-                raise RuntimeError(f"task added in database but could not be found: {inserted.inserted_id}")
+            task["_id"] = inserted.inserted_id
+            return self._to_dict(task)
         else:
             raise RuntimeError("failed to add task")
 
-    async def update_task(self, id: str, data: dict) -> dict:
-        updated = await self.collection.update_one({"_id": ObjectId(id)}, {"$set": data})
-        if updated.acknowledged:
-            task = await self.collection.find_one({"_id": ObjectId(id)})
-            if task:
-                return self._to_dict(task)
-            else:
-                raise RuntimeError(f"task updated in database but could not be found: {id}")
-        else:
-            raise RuntimeError(f"failed to update task")
-
-    async def replace_task(self, id: str, task: dict) -> dict:
-        replaced = await self.collection.replace_one({"_id": ObjectId(id)}, task)
-        if replaced.acknowledged:
-            task = await self.collection.find_one({"_id": ObjectId(id)})
-            if task:
-                return self._to_dict(task)
-            else:
-                raise RuntimeError(f"task replaced in database but could not be found: {id}")
-        else:
-            raise RuntimeError(f"failed to replace task")
+    def _update(self, data: dict, push: dict = None, bump_version: bool = True) -> dict:
+        # every write that changes a task bumps its version (the etag of its representation)
+        update = {"$set": data}
+        if push:
+            update["$push"] = push
+        if bump_version:
+            update["$inc"] = {"version": 1}
+        return update
 
-    async def delete_task(self, id: str) -> bool:
-        deleted = await self.collection.delete_one({"_id": ObjectId(id)})
+    async def update_task(
+        self, id: str, data: dict, condition: dict = None, push: dict = None, bump_version: bool = True
+    ) -> dict:
+        """atomically update a task & return the updated document. empty if no task matched `condition`"""
+        query = {"_id": ObjectId(id), **(condition or {})}
+        task = await self.collection.find_one_and_update(
+            query, self._update(data, push, bump_version), return_document=ReturnDocument.AFTER
+        )
+        return self._to_dict(task) if task else {}
+
+    # comments & to-do items of envelope tasks, read & written one item (or page of items) at a time
+    async def get_task_items(self, id: str, field: str, skip: int, limit: int) -> dict:
+        """a task without its task_data but for a page of the `field` list"""
+        task = await self.collection.find_one(
+            {"_id": ObjectId(id)},
+            {"created_by": 1, "layout": 1, "key_id": 1, f"task_data.{field}": {"$slice": [skip, limit]}},
+        )
+        return self._to_dict(task) if task else {}
+
+    async def get_task_item(self, id: str, field: str, item_id: str) -> dict:
+        """a task without its task_data but for the `field` item with `item_id`. empty if there's no such item"""
+        task = await self.collection.find_one(
+            {"_id": ObjectId(id), f"task_data.{field}.id": item_id},
+            {"created_by": 1, "layout": 1, "key_id": 1, f"task_data.{field}.$": 1},
+        )
+        return self._to_dict(task) if task else {}
+
+    async def push_task_item(self, id: str, field: str, item: dict, data: dict, condition: dict) -> bool:
+        """append an item to a task's `field` list & set `data`. False if no task matched `condition`"""
+        updated = await self.collection.update_one(
+            {"_id": ObjectId(id), **condition}, self._update(data, {f"task_data.{field}": item})
+        )
+        return updated.matched_count > 0
+
+    async def update_task_item(
+        self, id: str, field: str, previous: dict, item: dict, data: dict, condition: dict
+    ) -> bool:
+        """replace a `field` item in place & set `data`, if it's still `previous`. False if nothing matched"""
+        query = {"_id": ObjectId(id), **condition, f"task_data.{field}": {"$elemMatch": previous}}
+        updated = await self.collection.update_one(query, self._update({f"task_data.{field}.$": item, **data}))
+        return updated.matched_count > 0
+
+    async def delete_task(self, id: str, condition: dict = None) -> bool:
+        deleted = await self.collection.delete_one({"_id": ObjectId(id), **(condition or {})})
         if deleted.acknowledged:
             if deleted.deleted_count > 0:
                 return True
             else:
-                raise False
+                return False
         else:
             raise RuntimeError(f"failed to delete task")
+
+    # batch operations
+    async def get_tasks_by_ids(self, ids: List[str], projection: dict = None) -> Dict[str, dict]:
+        query = {"_id": {"$in": [ObjectId(id) for id in ids]}}
+        tasks = [self._to_dict(task) async for task in self.collection.find(query, projection)]
+        return {task["_id"]: task for task in tasks}
+
+    async def add_tasks(self, tasks: List[dict]) -> List[dict]:
+        """insert tasks in one round trip. returns the inserted tasks in order, empty for the ones that failed"""
+        try:
+            inserted = await self.collection.insert_many(tasks, ordered=False)
+            if not inserted.acknowledged:
+                raise RuntimeError("failed to add tasks")
+            failed = set()
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+
+        # insert_many sets the generated _id on each document
+        return [{} if i in failed else self._to_dict(task) for i, task in enumerate(tasks)]
+
+    async def update_tasks(self, updates: List[Tuple[str, dict, dict, dict]], bump_version: bool = True) -> int:
+        """apply (id, data, condition, push) updates in one round trip. returns the number of matched tasks"""
+        requests = [
+            UpdateOne({"_id": ObjectId(id), **condition}, self._update(data, push, bump_version))
+            for id, data, condition, push in updates
+        ]
+        try:
+            updated = await self.collection.bulk_write(requests, ordered=False)
+            return updated.matched_count
+        except BulkWriteError as e:
+            return e.details.get("nMatched", 0)
+
+    async def delete_tasks(self, ids: List[str], created_by: str) -> int:
+        deleted = await self.collection.delete_many(
+            {"_id": {"$in": [ObjectId(id) for id in ids]}, "created_by": created_by}
+        )
+        if deleted.acknowledged:
+            return deleted.deleted_count
+        else:
+            raise RuntimeError("failed to delete tasks")
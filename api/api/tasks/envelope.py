@@ -0,0 +1,192 @@
+"""
+task_data storage layouts.
+
+legacy tasks store their whole task_data as one fernet token (or, before encryption, as plain json), so changing a
+single field means decrypting, merging & re-encrypting all of it. tasks in the envelope layout store task_data as
+a dict with one token per top-level field, comments & to-do items with one token per item next to the item's id.
+a write then encrypts only what it changes & sets it in place, without reading the task first.
+
+tokens are base64 of a 12 byte nonce & aes-256-gcm over the field's json, authenticated with the field's path so
+tokens can't be swapped between fields or items. the aes key is derived from the dek with hkdf. per token that's
+an order of magnitude cheaper than fernet, which matters as a read now decrypts every field & item.
+
+envelope documents also carry the id of the dek they were sealed with, so in place writes can be made conditional
+on it: a wrong (but well formed) dek can't add fields nobody can decrypt. and the blind index of their data.
+
+layouts: none (legacy), 2 (envelope), 3 (envelope & blind index), 4 (with keyword tokens in the blind index). tasks
+in an older one are migrated when read.
+"""
+import hmac
+import os
+from base64 import b64decode, b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from hashlib import sha256
+from typing import Any, List, Optional, Tuple
+
+import orjson
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from fastapi.logger import logger
+from telemetry import CRYPTO_LATENCY, timed
+
+from api.security import ciphers, get_cipher
+
+from .blind_index import get_index_key, index_fields, index_update
+
+LAYOUT = 4
+OLD_LAYOUTS = [None, 2, 3]
+ITEM_FIELDS = ("comments", "todo_items")
+
+
+def is_legacy(task: dict) -> bool:
+    """in an older layout, to be migrated"""
+    return task.get("layout") != LAYOUT
+
+
+def key_id(dek: str) -> str:
+    """short id of a dek, safe to store as it's keyed by the dek itself. raises ValueError for invalid deks"""
+    _ = get_cipher(dek)
+    return hmac.new(dek.encode("utf-8"), b"task_data key id", sha256).hexdigest()[:16]
+
+
+def get_field_cipher(dek: str) -> AESGCM:
+    """aes-gcm cipher for a dek's envelope tokens, cached with the fernet ones. raises ValueError for invalid deks"""
+    key = b"envelope" + sha256(dek.encode("utf-8")).digest() if isinstance(dek, str) else None
+    cipher = ciphers.get(key) if key else None
+    if cipher is None:
+        _ = get_cipher(dek)
+        cipher = AESGCM(
+            HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"jiroapi-task-envelope-v2").derive(
+                urlsafe_b64decode(dek.encode("utf-8"))
+            )
+        )
+        ciphers.set(key, cipher, 1)
+    return cipher
+
+
+def _encrypt(cipher: AESGCM, path: str, value: Any) -> str:
+    nonce = os.urandom(12)
+    return b64encode(nonce + cipher.encrypt(nonce, orjson.dumps(value), path.encode("utf-8"))).decode("utf-8")
+
+
+def _decrypt(cipher: AESGCM, path: str, token: str) -> Any:
+    try:
+        payload = b64decode(token)
+        return orjson.loads(cipher.decrypt(payload[:12], payload[12:], path.encode("utf-8")))
+    except (BinasciiError, InvalidTag, TypeError):
+        raise ValueError(f"invalid envelope token: {path}")
+
+
+def _seal_item(cipher: AESGCM, field: str, item: dict) -> dict:
+    return {"id": item["id"], "data": _encrypt(cipher, f"{field}.{item['id']}", item)}
+
+
+def _seal(cipher: AESGCM, task_data: dict) -> dict:
+    sealed = {}
+    for field, value in task_data.items():
+        if value is None:
+            continue
+        if field in ITEM_FIELDS:
+            sealed[field] = [_seal_item(cipher, field, item) for item in value]
+        else:
+            sealed[field] = _encrypt(cipher, field, value)
+    return sealed
+
+
+def _unseal(dek: str, cipher: AESGCM, task: dict) -> dict:
+    task_data = task["task_data"]
+    if task.get("layout") is None:
+        if isinstance(task_data, dict):
+            return task_data
+        return orjson.loads(get_cipher(dek).decrypt(task_data.encode("utf-8")))
+
+    unsealed = {}
+    for field, value in task_data.items():
+        if field in ITEM_FIELDS:
+            unsealed[field] = [_decrypt(cipher, f"{field}.{item['id']}", item["data"]) for item in value]
+        else:
+            unsealed[field] = _decrypt(cipher, field, value)
+    return unsealed
+
+
+def _stored(dek: str, tasks_data: List[dict]) -> List[dict]:
+    cipher, id, index_key = get_field_cipher(dek), key_id(dek), get_index_key(dek)
+    return [
+        {
+            "task_data": _seal(cipher, task_data),
+            "layout": LAYOUT,
+            "key_id": id,
+            "blind_index": index_fields(index_key, task_data),
+        }
+        for task_data in tasks_data
+    ]
+
+
+@timed(CRYPTO_LATENCY, "seal")
+def seal(dek: str, task_data: dict) -> dict:
+    """the stored fields of a task's data: envelope, layout, dek id & blind index. raises ValueError for invalid deks"""
+    return _stored(dek, [task_data])[0]
+
+
+@timed(CRYPTO_LATENCY, "seal_many")
+def seal_many(dek: str, tasks_data: List[dict]) -> List[dict]:
+    return _stored(dek, tasks_data)
+
+
+@timed(CRYPTO_LATENCY, "seal_update")
+def seal_update(dek: str, changes: dict) -> Tuple[dict, dict]:
+    """
+    $set & $push applying a partial task_data to an envelope task, with the semantics of the full merge:
+    fields & the to-do list are replaced, comments appended. only the changed fields & new items are encrypted
+    """
+    cipher = get_field_cipher(dek)
+    to_set, to_push = {}, {}
+    for field, value in changes.items():
+        if field == "comments":
+            to_push[f"task_data.{field}"] = {"$each": [_seal_item(cipher, field, item) for item in value]}
+        elif field in ITEM_FIELDS:
+            to_set[f"task_data.{field}"] = [_seal_item(cipher, field, item) for item in value]
+        else:
+            to_set[f"task_data.{field}"] = _encrypt(cipher, field, value)
+
+    to_set.update(index_update(get_index_key(dek), changes))
+    return to_set, to_push
+
+
+@timed(CRYPTO_LATENCY, "seal_item")
+def seal_item(dek: str, field: str, item: dict) -> dict:
+    """a single comment or to-do item, to be pushed or set in place. raises ValueError for invalid deks"""
+    return _seal_item(get_field_cipher(dek), field, item)
+
+
+@timed(CRYPTO_LATENCY, "unseal")
+def unseal(dek: str, task: dict) -> Optional[dict]:
+    """decrypted task_data of a stored task, in either layout. None if the dek or the data is invalid"""
+    try:
+        return _unseal(dek, get_field_cipher(dek), task)
+    except (ValueError, InvalidToken):
+        return None
+
+
+@timed(CRYPTO_LATENCY, "unseal_many")
+def unseal_many(dek: str, tasks: List[dict]) -> Optional[List[dict]]:
+    """decrypt a page of tasks with one cipher. all or nothing, None if the dek or any task is invalid"""
+    try:
+        cipher = get_field_cipher(dek)
+        return [_unseal(dek, cipher, task) for task in tasks]
+    except (ValueError, InvalidToken):
+        logger.error("unable to decrypt tasks (invalid dek or task data)")
+        return None
+
+
+@timed(CRYPTO_LATENCY, "unseal_items")
+def unseal_items(dek: str, field: str, items: List[dict]) -> Optional[List[dict]]:
+    """decrypt some of an envelope task's comments or to-do items. None if the dek or any item is invalid"""
+    try:
+        cipher = get_field_cipher(dek)
+        return [_decrypt(cipher, f"{field}.{item['id']}", item["data"]) for item in items]
+    except ValueError:
+        return None
@@ -0,0 +1,53 @@
+from hashlib import blake2b
+from typing import List, Optional
+
+
+def task_version(task: dict) -> int:
+    # tasks written before versioning count as version 0
+    return task.get("version") or 0
+
+
+def task_etag(task: dict) -> str:
+    """strong etag of a task, its version. known without decrypting or serializing it"""
+    return f'"{task_version(task)}"'
+
+
+def page_etag(tasks: List[dict]) -> str:
+    """weak etag of a page of tasks, from its members' ids & versions"""
+    digest = blake2b(digest_size=16)
+    for task in tasks:
+        digest.update(f"{task['_id']}:{task_version(task)};".encode("utf-8"))
+    return f'W/"{digest.hexdigest()}"'
+
+
+def _tags(header: str) -> List[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def none_match(header: Optional[str], etag: str) -> bool:
+    """whether an If-None-Match header names `etag` (weak comparison), i.e. the client's copy is current"""
+    if not header:
+        return False
+    tags = _tags(header)
+    return "*" in tags or etag.replace("W/", "", 1) in {tag.replace("W/", "", 1) for tag in tags}
+
+
+def match_versions(header: Optional[str]) -> Optional[List[int]]:
+    """
+    task versions an If-Match header allows a write on (strong comparison, weak etags never match).
+    None when any version goes: no header or "*"
+    """
+    if not header or "*" in _tags(header):
+        return None
+
+    versions = []
+    for tag in _tags(header):
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
+
+def version_condition(versions: List[int]) -> dict:
+    """query condition on a task's version being one of `versions`"""
+    # null matches tasks without a version field, which are at version 0
+    return {"version": {"$in": versions + [None] if 0 in versions else versions}}
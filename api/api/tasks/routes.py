@@ -1,56 +1,500 @@
 import traceback
+import zlib
+from datetime import date, datetime
+from typing import Any, AsyncIterator, List, Tuple
 
+import orjson
 from app import CacheManager
-from fastapi import APIRouter, BackgroundTasks, Cookie, HTTPException, Response, status
+from bson.objectid import ObjectId
+from config import config
+from fastapi import APIRouter, BackgroundTasks, Cookie, Header, HTTPException, Response, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.logger import logger
-from fastapi.param_functions import Body, Depends
-from fastapi.responses import JSONResponse
+from fastapi.param_functions import Body, Depends, Query
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from mergedeep import Strategy, merge
 
-from api.security import decrypt_payload, encrypt_payload, get_current_active_user
-from api.users.schemas import UserInDB
+from api.serializers import compile_serializer, serialize_many
+from api.security import get_cipher, get_current_active_user
+from api.users.schemas import Principal
 
+from .blind_index import KEYWORD_FIELDS, index_query, keyword_index, matches, rank, search_tokens
+from .cursor import decode_cursor, encode_cursor
 from .db import TaskDBManager
-from .schemas import AddTaskWrapped, TaskInDBWrapped, UpdateTaskWrapped
+from .envelope import (
+    LAYOUT,
+    OLD_LAYOUTS,
+    is_legacy,
+    key_id,
+    seal,
+    seal_item,
+    seal_many,
+    seal_update,
+    unseal,
+    unseal_items,
+    unseal_many,
+)
+from .etag import match_versions, none_match, page_etag, task_etag, task_version, version_condition
+from .schemas import (
+    AddComment,
+    AddTaskWrapped,
+    AddToDoItem,
+    BulkDeleteTasks,
+    BulkUpdateTaskWrapped,
+    Comment,
+    PriorityType,
+    StatusType,
+    TaskInDBWrapped,
+    ToDoItem,
+    UpdateTaskWrapped,
+    UpdateToDoItem,
+)
 
 router = APIRouter()
 db = TaskDBManager()
 
+# tasks are validated on write, so responses skip the model and use a precompiled serializer + orjson
+serialize_task = compile_serializer(TaskInDBWrapped)
+serialize_comment = compile_serializer(Comment)
+serialize_todo_item = compile_serializer(ToDoItem)
+
+
+def _recursive_parse(d: dict):
+    for k, v in d.copy().items():
+        if isinstance(v, dict):
+            _recursive_parse(v)
+        else:
+            if v is None:
+                del d[k]
+
+
+def _merge_task_data(task_data: dict, update: dict) -> dict:
+    merged = merge({}, task_data, update, strategy=Strategy.REPLACE)
+    merged["todo_items"] = merge({}, task_data, update, strategy=Strategy.REPLACE).get("todo_items")
+    merged["comments"] = merge({}, task_data, update, strategy=Strategy.ADDITIVE).get("comments")
+    return merged
+
+
+def _stored_value(document: dict, path: str) -> Any:
+    for key in path.split("."):
+        document = document.get(key) if isinstance(document, dict) else None
+    return document
+
+
+async def _migrate_tasks(dek: str, tasks: List[Tuple[dict, dict]]):
+    """
+    lazy migration of legacy tasks a request has read, given with their decrypted task_data. each is rewritten in the
+    envelope layout, conditional on it not having changed since it was read
+    """
+    sealed = seal_many(dek, [task_data for _, task_data in tasks])
+    updates = [
+        (task["_id"], fields, {"task_data": task["task_data"]}, None) for (task, _), fields in zip(tasks, sealed)
+    ]
+    # the representation doesn't change, so neither does the version
+    _ = await db.update_tasks(updates, bump_version=False)
+    await CacheManager.delete_many([task["_id"] for task, _ in tasks])
+
+
+async def _migrate_task(dek: str, task: dict):
+    """migrate a legacy task ahead of an in place write, conditional on it not having changed since it was read"""
+    task_data = unseal(dek, task)
+    if not task_data:
+        raise _invalid_dek()
+    # the write after it tells if the migration lost to a concurrent update
+    _ = await db.update_task(task["_id"], seal(dek, task_data), {"task_data": task["task_data"]}, bump_version=False)
+
+
+async def _get_owned_task(id: str, created_by: str) -> dict:
+    task = await db.get_task_by_id(id)
+    if not task:
+        raise HTTPException(detail="task not found", status_code=status.HTTP_404_NOT_FOUND)
+
+    if task.get("created_by") != created_by:
+        raise HTTPException(
+            detail="not enough permissions",
+            status_code=status.HTTP_401_UNAUTHORIZED,
+        )
+    return task
+
+
+def _etag_mismatch() -> HTTPException:
+    return HTTPException(
+        detail="task was modified since it was fetched (etag mismatch)",
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
+def _invalid_dek() -> HTTPException:
+    return HTTPException(
+        detail="task data empty or unable to decrypt data (invalid dek)",
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
+
+
+# bulk operations. declared ahead of the "/{id}" routes so "bulk" isn't taken for a task id
+def _check_bulk_size(items: list):
+    if not items:
+        raise HTTPException(detail="no items to process", status_code=status.HTTP_400_BAD_REQUEST)
+
+    if len(items) > config.TASKS_BULK_MAX_ITEMS:
+        raise HTTPException(
+            detail=f"too many items, at most {config.TASKS_BULK_MAX_ITEMS} per request",
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
+
+
+def _bulk_result(index: int, id: str, status_code: int, detail: str = None) -> dict:
+    result = {"index": index, "id": id, "status": status_code}
+    if detail:
+        result["detail"] = detail
+    return result
+
+
+@router.post("/bulk")
+async def create_tasks(
+    payload: List[AddTaskWrapped] = Body(...),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """create multiple user's tasks"""
+    try:
+        _check_bulk_size(payload)
+
+        tasks = []
+        for item in payload:
+            item.created_by = current_user.id
+            tasks.append(jsonable_encoder(item))
+
+        try:
+            sealed = seal_many(dek, [task["task_data"] for task in tasks])
+        except ValueError:
+            raise _invalid_dek()
+        for task, fields in zip(tasks, sealed):
+            task.update(fields, version=1)
+
+        inserted = await db.add_tasks(tasks)
+        await CacheManager.bump_generation(current_user.id)
+
+        results = [
+            _bulk_result(i, task["_id"], status.HTTP_201_CREATED)
+            if task
+            else _bulk_result(i, None, status.HTTP_500_INTERNAL_SERVER_ERROR, "task creation failed")
+            for i, task in enumerate(inserted)
+        ]
+        return JSONResponse(content=results, status_code=status.HTTP_207_MULTI_STATUS)
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="task creation failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@router.patch("/bulk")
+async def update_tasks(
+    payload: List[BulkUpdateTaskWrapped] = Body(...),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """update multiple user's tasks"""
+    try:
+        _check_bulk_size(payload)
+
+        results = [None] * len(payload)
+        valid_ids = [item.id for item in payload if ObjectId.is_valid(item.id)]
+        tasks = await db.get_tasks_by_ids(valid_ids) if valid_ids else {}
+
+        try:
+            dek_id = key_id(dek)
+        except ValueError:
+            dek_id = None
+
+        updates, legacy = [], []
+        for i, item in enumerate(payload):
+            task = tasks.get(item.id)
+            if not task:
+                results[i] = _bulk_result(i, item.id, status.HTTP_404_NOT_FOUND, "task not found")
+                continue
+
+            if task.get("created_by") != current_user.id:
+                results[i] = _bulk_result(i, item.id, status.HTTP_401_UNAUTHORIZED, "not enough permissions")
+                continue
+
+            data = jsonable_encoder(item)
+            _recursive_parse(data)
+            data.pop("id")
+            task_data = data.pop("task_data", None)
+
+            # envelope tasks get their changed fields set in place, conditional on the dek they were sealed with.
+            # legacy ones are merged & migrated, conditional on task_data not having changed since it was read
+            condition, push = {"created_by": current_user.id}, None
+            if task_data and is_legacy(task):
+                current = unseal(dek, task)
+                if not current:
+                    results[i] = _bulk_result(
+                        i, item.id, status.HTTP_500_INTERNAL_SERVER_ERROR, "unable to decrypt data (invalid dek)"
+                    )
+                    continue
+
+                condition["task_data"] = task["task_data"]
+                legacy.append((data, _merge_task_data(current, task_data)))
+            elif task_data:
+                if task.get("key_id") != dek_id:
+                    results[i] = _bulk_result(
+                        i, item.id, status.HTTP_500_INTERNAL_SERVER_ERROR, "unable to decrypt data (invalid dek)"
+                    )
+                    continue
+
+                condition.update(layout=LAYOUT, key_id=dek_id)
+                changes, push = seal_update(dek, task_data)
+                data.update(changes)
+
+            updates.append((i, item.id, data, condition, push))
+
+        if legacy:
+            try:
+                sealed = seal_many(dek, [task_data for _, task_data in legacy])
+            except ValueError:
+                raise _invalid_dek()
+            for (data, _), fields in zip(legacy, sealed):
+                data.update(fields)
+
+        if updates:
+            matched = await db.update_tasks([(id, data, condition, push) for _, id, data, condition, push in updates])
+
+            # some conditional writes lost to a concurrent update, find out which ones
+            applied = None
+            if matched < len(updates):
+                stored = await db.get_tasks_by_ids([id for _, id, _, _, _ in updates])
+                applied = {
+                    id
+                    for _, id, data, _, _ in updates
+                    if all(_stored_value(stored.get(id, {}), k) == v for k, v in data.items())
+                }
+
+            for i, id, _, _, _ in updates:
+                if applied is None or id in applied:
+                    results[i] = _bulk_result(i, id, status.HTTP_200_OK)
+                else:
+                    results[i] = _bulk_result(
+                        i, id, status.HTTP_409_CONFLICT, "task was modified by another request, retry the update"
+                    )
+
+            await CacheManager.delete_many([id for _, id, _, _, _ in updates])
+
+        return JSONResponse(content=results, status_code=status.HTTP_207_MULTI_STATUS)
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="task updation failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@router.delete("/bulk")
+async def delete_tasks(
+    payload: BulkDeleteTasks = Body(...),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """delete multiple user's tasks"""
+    try:
+        _check_bulk_size(payload.ids)
+
+        valid_ids = [id for id in payload.ids if ObjectId.is_valid(id)]
+        tasks = await db.get_tasks_by_ids(valid_ids, projection={"created_by": 1}) if valid_ids else {}
+
+        results, owned = [], []
+        for i, id in enumerate(payload.ids):
+            task = tasks.get(id)
+            if not task:
+                results.append(_bulk_result(i, id, status.HTTP_404_NOT_FOUND, "task not found"))
+            elif task.get("created_by") != current_user.id:
+                results.append(_bulk_result(i, id, status.HTTP_401_UNAUTHORIZED, "not enough permissions"))
+            else:
+                results.append(_bulk_result(i, id, status.HTTP_204_NO_CONTENT))
+                owned.append(id)
+
+        if owned:
+            _ = await db.delete_tasks(owned, current_user.id)
+            await CacheManager.delete_many(owned)
+            await CacheManager.bump_generation(current_user.id)
+
+        return JSONResponse(content=results, status_code=status.HTTP_207_MULTI_STATUS)
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="task deletion failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@router.get("/export")
+async def export_tasks(
+    gzip: bool = False,
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """export all of user's tasks as newline delimited json, streamed as they are read from the database"""
+    try:
+        _ = get_cipher(dek)
+    except ValueError:
+        raise HTTPException(
+            detail="unable to decrypt data (invalid dek)",
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+
+    async def __lines() -> AsyncIterator[bytes]:
+        # the first line goes out as soon as it's decrypted so the client starts receiving right away, the rest
+        # in chunks of a batch
+        batch, first = [], True
+        async for task in db.iter_tasks_by_created_by(current_user.id, config.TASKS_EXPORT_BATCH_SIZE):
+            task_data = unseal(dek, task)
+            if task_data:
+                line = serialize_task({**task, "task_data": task_data})
+            else:
+                line = {"_id": task["_id"], "error": "unable to decrypt task data"}
+            batch.append(orjson.dumps(line))
+
+            if first or len(batch) >= config.TASKS_EXPORT_BATCH_SIZE:
+                yield b"\n".join(batch) + b"\n"
+                batch, first = [], False
+
+        if batch:
+            yield b"\n".join(batch) + b"\n"
+
+    async def __gzipped(lines: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        async for chunk in lines:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    headers = {"Content-Disposition": 'attachment; filename="tasks.ndjson"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(
+        __gzipped(__lines()) if gzip else __lines(),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+@router.get("/search")
+async def search_tasks(
+    background_tasks: BackgroundTasks,
+    q: str = Query(..., min_length=1, max_length=256),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(25, ge=1, le=100),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """
+    search user's tasks for keywords of their title, topic & description. tasks are ranked on the database's
+    keyword tokens, only the page returned is decrypted. the number of matches is sent as `X-Total-Count`
+    """
+    try:
+        try:
+            tokens = search_tokens(dek, q)
+        except ValueError:
+            raise _invalid_dek()
+        if not tokens:
+            raise HTTPException(detail="search has no keywords", status_code=status.HTTP_400_BAD_REQUEST)
+
+        candidates = await db.search_tasks(
+            current_user.id, list(KEYWORD_FIELDS), tokens, OLD_LAYOUTS, config.TASKS_SEARCH_MAX_CANDIDATES
+        )
+        scores = {
+            task["_id"]: rank(tokens, task.get("blind_index", {}).get("keywords", {}))
+            for task in candidates
+            if not is_legacy(task)
+        }
+
+        # tasks in an older layout have no keyword tokens yet, they are ranked on their decrypted data (& migrated)
+        legacy_ids = [task["_id"] for task in candidates if is_legacy(task)]
+        legacy = await db.get_tasks_by_ids(legacy_ids) if legacy_ids else {}
+        if legacy:
+            legacy_data = unseal_many(dek, list(legacy.values()))
+            if not legacy_data or not all(legacy_data):
+                raise _invalid_dek()
+            for task, task_data in zip(legacy.values(), legacy_data):
+                scores[task["_id"]] = rank(tokens, keyword_index(dek, task_data))
+            background_tasks.add_task(_migrate_tasks, dek, list(zip(legacy.values(), legacy_data)))
+
+        # best match first, older tasks first among equal ones
+        ranked = sorted((id for id in scores if scores[id]), key=lambda id: (-scores[id], id))
+        ids = ranked[skip : skip + limit]
+        if not ids:
+            raise HTTPException(detail="tasks not found", status_code=status.HTTP_404_NOT_FOUND)
+
+        missing = [id for id in ids if id not in legacy]
+        found = await db.get_tasks_by_ids(missing) if missing else {}
+        found.update(legacy)
+        tasks = [found[id] for id in ids if id in found and found[id].get("created_by") == current_user.id]
+
+        tasks_data = unseal_many(dek, tasks)
+        if not tasks_data or not all(tasks_data):
+            raise _invalid_dek()
+
+        return ORJSONResponse(
+            content=serialize_many(
+                serialize_task, [{**task, "task_data": task_data} for task, task_data in zip(tasks, tasks_data)]
+            ),
+            status_code=status.HTTP_200_OK,
+            headers={"X-Total-Count": str(len(ranked))},
+        )
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="task search failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
 
 @router.get("/{id}")
 async def get_task(
     id: str,
     background_tasks: BackgroundTasks,
     dek: str = Cookie(None),
-    current_user: UserInDB = Depends(get_current_active_user),
+    if_none_match: str = Header(None),
+    current_user: Principal = Depends(get_current_active_user),
 ):
-    """fetch user's task"""
+    """fetch user's task. answers `If-None-Match` with 304 when the task's `ETag` still matches"""
     try:
+        # a cache hit stores nothing, a miss fills the cache without evicting other workers' copies
         task = await CacheManager.fetch(id)
         if not task:
             task = await db.get_task_by_id(id)
+            if task:
+                background_tasks.add_task(CacheManager.store, id, dict(task), invalidate=False)
 
         if not task:
             raise HTTPException(detail="task not found", status_code=status.HTTP_404_NOT_FOUND)
 
-        background_tasks.add_task(CacheManager.store, id, task)
         if task.get("created_by") != current_user.id:
             raise HTTPException(
                 detail="not enough permissions",
                 status_code=status.HTTP_401_UNAUTHORIZED,
             )
 
-        task["task_data"] = decrypt_payload(dek, task["task_data"])
-        if not task["task_data"]:
+        # the version is known without decrypting anything, an unchanged task costs no crypto or serialization
+        etag = task_etag(task)
+        if none_match(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        task_data = unseal(dek, task)
+        if not task_data:
             raise HTTPException(
                 detail="task data empty or unable to decrypt data (invalid dek)", 
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
-        
-        return JSONResponse(
-            content=jsonable_encoder(TaskInDBWrapped(**task)),
+
+        if is_legacy(task):
+            background_tasks.add_task(_migrate_tasks, dek, [(task, task_data)])
+
+        return ORJSONResponse(
+            content=serialize_task({**task, "task_data": task_data}),
             status_code=status.HTTP_200_OK,
+            headers={"ETag": etag},
         )
     except RuntimeError:
         logger.error(traceback.print_exc())
@@ -65,33 +509,102 @@ async def get_tasks(
     background_tasks: BackgroundTasks,
     skip: int = 0,
     limit: int = 25,
+    after: str = None,
+    status_: List[StatusType] = Query(None, alias="status"),
+    priority: List[PriorityType] = Query(None),
+    due_before: date = None,
     dek: str = Cookie(None),
-    current_user: UserInDB = Depends(get_current_active_user),
+    if_none_match: str = Header(None),
+    current_user: Principal = Depends(get_current_active_user),
 ):
-    """fetch multiple user's tasks"""
+    """
+    fetch multiple user's tasks. pass the `X-Next-Cursor` of a page as `after` to fetch the next one.
+    filter on `status` & `priority` (repeat them for several values) and on tasks due before a date.
+    pages have a weak `ETag`, `If-None-Match` is answered with 304 while none of their tasks changed
+    """
+    statuses = [value.value for value in status_ or []]
+    priorities = [value.value for value in priority or []]
     try:
-        key = f"({current_user.id})({skip},{limit})"
-        tasks = await CacheManager.fetch(key)
-        if not tasks:
-            tasks = await db.get_tasks_by_created_by(current_user.id, skip, limit)
-
-        if not tasks:
-            raise HTTPException(detail="tasks not found", status_code=status.HTTP_404_NOT_FOUND)
-
-        background_tasks.add_task(CacheManager.store, key, tasks)
-
-        tasks_out = []
-        for task in tasks:
-            task["task_data"] = decrypt_payload(dek, task["task_data"])
-            if not task["task_data"]:
-                raise HTTPException(
-                    detail="task data empty or unable to decrypt data (invalid dek)", 
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-
-            tasks_out.append(jsonable_encoder(TaskInDBWrapped(**task)))
+        if after is not None:
+            try:
+                after_id = decode_cursor(after)
+            except ValueError:
+                raise HTTPException(detail="invalid cursor", status_code=status.HTTP_400_BAD_REQUEST)
+            page = f"after:{after_id},{limit}"
+        else:
+            after_id = None
+            page = f"{skip},{limit}"
+
+        if statuses or priorities or due_before:
+            try:
+                filters = index_query(dek, statuses, priorities, due_before)
+            except ValueError:
+                raise _invalid_dek()
+
+            # answered from the blind indexes. tasks in an older layout aren't indexed, they are matched after they
+            # are decrypted (& migrated). filtered pages aren't cached, an update can change which tasks they hold
+            filters = {"$or": [filters, {"layout": {"$in": OLD_LAYOUTS}}]}
+            tasks = await db.get_tasks_by_created_by(current_user.id, skip, limit, after=after_id, filters=filters)
+            ids = [task["_id"] for task in tasks]
+            if not ids:
+                raise HTTPException(detail="tasks not found", status_code=status.HTTP_404_NOT_FOUND)
+            background_tasks.add_task(
+                CacheManager.store_many, {task["_id"]: task for task in tasks}, invalidate=False
+            )
+        else:
+            generation = await CacheManager.get_generation(current_user.id)
+            key = f"({current_user.id})(gen:{generation})(ids:{page})"
+
+            async def __load_page() -> List[str]:
+                tasks = await db.get_tasks_by_created_by(current_user.id, skip, limit, after=after_id)
+                _ = await CacheManager.store_many({task["_id"]: task for task in tasks}, invalidate=False)
+                return [task["_id"] for task in tasks]
+
+            # pages are cached as lists of task ids, the tasks themselves once each under their id.
+            # concurrent misses on a page share a single database read
+            ids = await CacheManager.fetch_or_load(key, __load_page)
+            if not ids:
+                raise HTTPException(detail="tasks not found", status_code=status.HTTP_404_NOT_FOUND)
+
+            tasks = await CacheManager.fetch_many(ids)
+            missing = [id for id, task in zip(ids, tasks) if not task]
+            if missing:
+                found = await db.get_tasks_by_ids(missing)
+                background_tasks.add_task(CacheManager.store_many, found, invalidate=False)
+                tasks = [task or found.get(id) for id, task in zip(ids, tasks)]
+
+        # tasks deleted since the page was cached are skipped
+        tasks = [task for task in tasks if task and task.get("created_by") == current_user.id]
+
+        headers = {"ETag": page_etag(tasks)}
+        if len(ids) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(ids[-1])
+
+        if none_match(if_none_match, headers["ETag"]):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        # decrypt into new documents, the cached page is stored with its task_data still encrypted
+        tasks_data = unseal_many(dek, tasks)
+        if not tasks_data or not all(tasks_data):
+            raise HTTPException(
+                detail="task data empty or unable to decrypt data (invalid dek)", 
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
 
-        return JSONResponse(content=tasks_out, status_code=status.HTTP_200_OK)
+        legacy = [(task, task_data) for task, task_data in zip(tasks, tasks_data) if is_legacy(task)]
+        if legacy:
+            background_tasks.add_task(_migrate_tasks, dek, legacy)
+        tasks_out = [
+            {**task, "task_data": task_data}
+            for task, task_data in zip(tasks, tasks_data)
+            if not is_legacy(task) or matches(task_data, statuses, priorities, due_before)
+        ]
+
+        return ORJSONResponse(
+            content=serialize_many(serialize_task, tasks_out),
+            status_code=status.HTTP_200_OK,
+            headers=headers,
+        )
     except RuntimeError:
         logger.error(traceback.print_exc())
         raise HTTPException(
@@ -105,28 +618,27 @@ async def create_task(
     background_tasks: BackgroundTasks,
     payload: AddTaskWrapped = Body(...),
     dek: str = Cookie(None),
-    current_user: UserInDB = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
 ):
     """create new user's task"""
     try:
         payload.created_by = current_user.id
         payload = jsonable_encoder(payload)
-        payload["task_data"] = encrypt_payload(dek, payload["task_data"])
+        task_data = payload["task_data"]
+        try:
+            payload.update(seal(dek, task_data), version=1)
+        except ValueError:
+            raise _invalid_dek()
 
         task = await db.add_task(payload)
-        background_tasks.add_task(CacheManager.store, task.get("_id"), task)
-        background_tasks.add_task(CacheManager.delete, f"""({task.get("created_by")})(*)""", True)
+        background_tasks.add_task(CacheManager.store, task.get("_id"), dict(task))
+        await CacheManager.bump_generation(current_user.id)
 
-        task["task_data"] = decrypt_payload(dek, task["task_data"])
-        if not task["task_data"]:
-            raise HTTPException(
-                detail="task data empty or unable to decrypt data (invalid dek)", 
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
-        
-        return JSONResponse(
-            content=jsonable_encoder(TaskInDBWrapped(**task)),
+        # the plaintext was just sealed, no need to decrypt it back
+        return ORJSONResponse(
+            content=serialize_task({**task, "task_data": task_data}),
             status_code=status.HTTP_201_CREATED,
+            headers={"ETag": task_etag(task)},
         )
     except RuntimeError:
         logger.error(traceback.print_exc())
@@ -139,21 +651,78 @@ async def create_task(
 @router.put("/{id}")
 async def update_task(
     id: str,
-    background_tasks: BackgroundTasks,
     payload: UpdateTaskWrapped = Body(...),
     dek: str = Cookie(None),
-    current_user: UserInDB = Depends(get_current_active_user),
+    if_match: str = Header(None),
+    current_user: Principal = Depends(get_current_active_user),
 ):
-    """update user's task"""
+    """update user's task. with `If-Match`, only if the task's `ETag` still matches (412 otherwise)"""
+    try:
+        payload = jsonable_encoder(payload)
+        _recursive_parse(payload)
+        task_data = payload.pop("task_data", None)
+        versions = match_versions(if_match)
+
+        # changed task_data fields are encrypted alone & set in place, new comments pushed. the write is conditional
+        # on ownership, and when task_data changes, on the task being in the envelope layout & sealed with this dek.
+        # so a PUT costs one round trip, legacy tasks are migrated on their first one
+        condition, push = {"created_by": current_user.id}, None
+        if task_data:
+            try:
+                changes, push = seal_update(dek, task_data)
+                condition.update(layout=LAYOUT, key_id=key_id(dek))
+            except ValueError:
+                raise _invalid_dek()
+            payload.update(changes)
+        if versions is not None:
+            condition.update(version_condition(versions))
+
+        task = await db.update_task(id, payload, condition, push)
+        if not task:
+            existing = await _get_owned_task(id, current_user.id)
+            if versions is not None and task_version(existing) not in versions:
+                raise _etag_mismatch()
+            if not task_data:
+                raise RuntimeError(f"task could not be updated: {id}")
+            if not is_legacy(existing):
+                raise _invalid_dek()
+
+            await _migrate_task(dek, existing)
+            task = await db.update_task(id, payload, condition, push)
+            if not task:
+                raise HTTPException(
+                    detail="task was modified by another request, retry the update",
+                    status_code=status.HTTP_409_CONFLICT,
+                )
 
-    def __recursive_parse(d: dict):
-        for k, v in d.copy().items():
-            if isinstance(v, dict):
-                __recursive_parse(v)
-            else:
-                if v is None:
-                    del d[k]
+        # list pages only hold task ids, refreshing the cached task is all the invalidation an update needs
+        await CacheManager.store(id, dict(task))
 
+        task_data = unseal(dek, task)
+        if not task_data:
+            raise _invalid_dek()
+
+        return ORJSONResponse(
+            content=serialize_task({**task, "task_data": task_data}),
+            status_code=status.HTTP_201_CREATED,
+            headers={"ETag": task_etag(task)},
+        )
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="task updation failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@router.delete("/{id}")
+async def delete_task(
+    id: str,
+    background_tasks: BackgroundTasks,
+    if_match: str = Header(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """delete user's task. with `If-Match`, only if the task's `ETag` still matches (412 otherwise)"""
     try:
         task = await db.get_task_by_id(id)
         if not task:
@@ -165,62 +734,166 @@ async def update_task(
                 status_code=status.HTTP_401_UNAUTHORIZED,
             )
 
-        payload = jsonable_encoder(payload)
-        __recursive_parse(payload)
+        versions = match_versions(if_match)
+        if versions is None:
+            _ = await db.delete_task(id)
+        elif task_version(task) not in versions or not await db.delete_task(id, version_condition(versions)):
+            raise _etag_mismatch()
 
-        if payload.get("task_data"):
-            task["task_data"] = decrypt_payload(dek, task["task_data"])
-            if not task["task_data"]:
-                raise HTTPException(
-                    detail="task data empty or unable to decrypt data (invalid dek)", 
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+        background_tasks.add_task(CacheManager.delete, id)
+        await CacheManager.bump_generation(current_user.id)
+        return Response(content=None, status_code=status.HTTP_204_NO_CONTENT)
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="task deletion failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
 
-            _task = task.copy()
-            _task["task_data"] = merge({}, task["task_data"], payload["task_data"], strategy=Strategy.REPLACE)
-            _task["task_data"]["todo_items"] = merge({}, task["task_data"], payload["task_data"], strategy=Strategy.REPLACE).get("todo_items")
-            _task["task_data"]["comments"] = merge({}, task["task_data"], payload["task_data"], strategy=Strategy.ADDITIVE).get("comments")
 
-            task["task_data"] = encrypt_payload(dek, _task["task_data"])
-            task.pop("_id")
-            
-            _ = await db.replace_task(id, task)
-            payload.pop("task_data")
+# comments & to-do items. each is encrypted on its own in envelope tasks, so these read & write single items
+# (or a page of them) without decrypting, or even reading, the rest of the task
+async def _push_item(id: str, field: str, item: dict, dek: str, current_user: Principal):
+    """append an item with one conditional $push. legacy tasks are migrated first"""
+    try:
+        sealed = seal_item(dek, field, item)
+        condition = {"created_by": current_user.id, "layout": LAYOUT, "key_id": key_id(dek)}
+    except ValueError:
+        raise _invalid_dek()
+    data = {"modified": jsonable_encoder(datetime.now())}
+
+    if not await db.push_task_item(id, field, sealed, data, condition):
+        task = await _get_owned_task(id, current_user.id)
+        if not is_legacy(task):
+            raise _invalid_dek()
+
+        await _migrate_task(dek, task)
+        if not await db.push_task_item(id, field, sealed, data, condition):
+            raise HTTPException(
+                detail="task was modified by another request, retry the update",
+                status_code=status.HTTP_409_CONFLICT,
+            )
+
+    await CacheManager.delete(id)
 
-        task = await db.update_task(id, payload)
-        background_tasks.add_task(CacheManager.store, id, task)
-        background_tasks.add_task(CacheManager.delete, f"({current_user.id})(*)", True)
 
-        task["task_data"] = decrypt_payload(dek, task["task_data"])
-        if not task["task_data"]:
+@router.get("/{id}/comments")
+async def get_comments(
+    id: str,
+    background_tasks: BackgroundTasks,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(25, ge=1, le=100),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """fetch a page of user's task comments, oldest first"""
+    try:
+        task = await db.get_task_items(id, "comments", skip, limit)
+        if not task:
+            raise HTTPException(detail="task not found", status_code=status.HTTP_404_NOT_FOUND)
+
+        if task.get("created_by") != current_user.id:
             raise HTTPException(
-                detail="task data empty or unable to decrypt data (invalid dek)", 
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+                detail="not enough permissions",
+                status_code=status.HTTP_401_UNAUTHORIZED,
             )
-        
-        return JSONResponse(
-            content=jsonable_encoder(TaskInDBWrapped(**task)),
+
+        if is_legacy(task):
+            task = await db.get_task_by_id(id)
+            task_data = unseal(dek, task)
+            if not task_data:
+                raise _invalid_dek()
+
+            background_tasks.add_task(_migrate_tasks, dek, [(task, task_data)])
+            comments = (task_data.get("comments") or [])[skip : skip + limit]
+        else:
+            comments = unseal_items(dek, "comments", task.get("task_data", {}).get("comments", []))
+            if comments is None:
+                raise _invalid_dek()
+
+        return ORJSONResponse(
+            content=serialize_many(serialize_comment, comments),
+            status_code=status.HTTP_200_OK,
+        )
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="comments fetch failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@router.post("/{id}/comments")
+async def add_comment(
+    id: str,
+    payload: AddComment = Body(...),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """add a comment to user's task"""
+    try:
+        comment = jsonable_encoder(Comment(**payload.dict()))
+        await _push_item(id, "comments", comment, dek, current_user)
+
+        return ORJSONResponse(
+            content=serialize_comment(comment),
             status_code=status.HTTP_201_CREATED,
         )
     except RuntimeError:
         logger.error(traceback.print_exc())
         raise HTTPException(
-            detail="task updation failed",
+            detail="comment creation failed",
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
 
 
-@router.delete("/{id}")
-async def delete_task(
+@router.post("/{id}/todo_items")
+async def add_todo_item(
     id: str,
-    background_tasks: BackgroundTasks,
-    current_user: UserInDB = Depends(get_current_active_user),
+    payload: AddToDoItem = Body(...),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
 ):
-    """delete user's task"""
+    """add a to-do item to user's task"""
     try:
-        task = await db.get_task_by_id(id)
+        todo_item = jsonable_encoder(ToDoItem(**payload.dict()))
+        await _push_item(id, "todo_items", todo_item, dek, current_user)
+
+        return ORJSONResponse(
+            content=serialize_todo_item(todo_item),
+            status_code=status.HTTP_201_CREATED,
+        )
+    except RuntimeError:
+        logger.error(traceback.print_exc())
+        raise HTTPException(
+            detail="to-do item creation failed",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@router.patch("/{id}/todo_items/{item_id}")
+async def update_todo_item(
+    id: str,
+    item_id: str,
+    payload: UpdateToDoItem = Body(...),
+    dek: str = Cookie(None),
+    current_user: Principal = Depends(get_current_active_user),
+):
+    """update a to-do item of user's task"""
+    try:
+        changes = jsonable_encoder(payload)
+        _recursive_parse(changes)
+
+        task = await db.get_task_item(id, "todo_items", item_id)
         if not task:
-            raise HTTPException(detail="task not found", status_code=status.HTTP_404_NOT_FOUND)
+            # no such task or item, or a legacy task (whose items can't be looked up), migrated & looked up again
+            existing = await _get_owned_task(id, current_user.id)
+            if is_legacy(existing):
+                await _migrate_task(dek, existing)
+                task = await db.get_task_item(id, "todo_items", item_id)
+
+        if not task:
+            raise HTTPException(detail="to-do item not found", status_code=status.HTTP_404_NOT_FOUND)
 
         if task.get("created_by") != current_user.id:
             raise HTTPException(
@@ -228,14 +901,32 @@ async def delete_task(
                 status_code=status.HTTP_401_UNAUTHORIZED,
             )
 
-        _ = await db.delete_task(id)
+        previous = task["task_data"]["todo_items"][0]
+        todo_items = unseal_items(dek, "todo_items", [previous])
+        if not todo_items:
+            raise _invalid_dek()
 
-        background_tasks.add_task(CacheManager.delete, id)
-        background_tasks.add_task(CacheManager.delete, f"({current_user.id})(*)", True)
-        return Response(content=None, status_code=status.HTTP_204_NO_CONTENT)
+        todo_item = {**todo_items[0], **changes}
+        data = {"modified": jsonable_encoder(datetime.now())}
+
+        # in place, conditional on the item not having changed since it was read
+        updated = await db.update_task_item(
+            id, "todo_items", previous, seal_item(dek, "todo_items", todo_item), data, {"created_by": current_user.id}
+        )
+        if not updated:
+            raise HTTPException(
+                detail="to-do item was modified by another request, retry the update",
+                status_code=status.HTTP_409_CONFLICT,
+            )
+
+        await CacheManager.delete(id)
+        return ORJSONResponse(
+            content=serialize_todo_item(todo_item),
+            status_code=status.HTTP_200_OK,
+        )
     except RuntimeError:
         logger.error(traceback.print_exc())
         raise HTTPException(
-            detail="task deletion failed",
+            detail="to-do item updation failed",
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
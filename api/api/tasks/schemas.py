@@ -95,3 +95,27 @@ class UpdateTaskWrapped(BaseModel):
     task_data: UpdateTask
     archived: Optional[bool] = False
     modified: Optional[datetime] = Field(default_factory=datetime.now)
+
+
+# schemas for "task comments & to-do items"
+class AddComment(BaseModel):
+    comment: str
+
+
+class AddToDoItem(BaseModel):
+    item: str
+    is_done: Optional[bool] = False
+
+
+class UpdateToDoItem(BaseModel):
+    item: Optional[str]
+    is_done: Optional[bool]
+
+
+# schemas for "bulk task operations"
+class BulkUpdateTaskWrapped(UpdateTaskWrapped):
+    id: str
+
+
+class BulkDeleteTasks(BaseModel):
+    ids: List[str]
@@ -1,18 +1,21 @@
-import asyncio
-
 from app import DatabaseManager
 from bson.objectid import ObjectId
 from config import config
+from pymongo import ASCENDING, IndexModel, ReturnDocument
 
 
 class UserDBManager(DatabaseManager):
     """database manager for users route"""
 
-    def __init__(self) -> None:
-        DatabaseManager._client.get_io_loop = asyncio.get_running_loop
-
-        self.db = DatabaseManager._client[config.MONGODB_DB]
-        self.collection = self.db[config.MONGODB_COLLECTION_USERS]
+    db_name = config.MONGODB_DB
+    collection_name = config.MONGODB_COLLECTION_USERS
+    indexes = [
+        IndexModel([("email", ASCENDING)], name="email_1", unique=True),
+    ]
+    queries = {
+        "get_user_by_id": ({"_id": ObjectId()}, None),
+        "get_user_by_email": ({"email": ""}, None),
+    }
 
     def _to_dict(self, record: dict) -> dict:
         record["_id"] = str(record["_id"])
@@ -29,21 +32,16 @@ class UserDBManager(DatabaseManager):
     async def add_user(self, user: dict) -> dict:
         inserted = await self.collection.insert_one(user)
         if inserted.acknowledged:
-            user = await self.collection.find_one({"_id": inserted.inserted_id})
-            if user:
-                return self._to_dict(user)
-            else:
-                raise RuntimeError(f"user added in database but could not be found: {inserted.inserted_id}")
+            user["_id"] = inserted.inserted_id
+            return self._to_dict(user)
         else:
             raise RuntimeError("failed to add user")
 
     async def update_user(self, id: str, data: dict) -> dict:
-        updated = await self.collection.update_one({"_id": ObjectId(id)}, {"$set": data})
-        if updated.acknowledged:
-            user = await self.collection.find_one({"_id": ObjectId(id)})
-            if user:
-                return self._to_dict(user)
-            else:
-                raise RuntimeError(f"user updated in database but could not be found: {id}")
+        user = await self.collection.find_one_and_update(
+            {"_id": ObjectId(id)}, {"$set": data}, return_document=ReturnDocument.AFTER
+        )
+        if user:
+            return self._to_dict(user)
         else:
-            raise RuntimeError(f"failed to update user")
+            raise RuntimeError(f"user could not be found to update: {id}")
@@ -8,14 +8,15 @@ from fastapi.param_functions import Body, Depends
 from fastapi.responses import JSONResponse
 
 from api.security import (
-    check_pw_hash,
-    decrypt_dek,
-    generate_encrypted_dek,
+    check_pw_hash_async,
+    decrypt_dek_async,
+    generate_encrypted_dek_async,
     get_current_active_user,
-    hash_pw,
+    hash_pw_async,
+    invalidate_principal,
     update_user_with_salt_dek,
 )
-from api.users.schemas import UserInDB
+from api.users.schemas import Principal, UserInDB
 
 from .db import UserDBManager
 from .schemas import (
@@ -48,7 +49,7 @@ async def create_user(background_tasks: BackgroundTasks, payload: CreateUser = B
             first_name=payload.first_name,
             last_name=payload.last_name,
             email=payload.email,
-            hashed_password=hash_pw(payload.password.get_secret_value()),
+            hashed_password=await hash_pw_async(payload.password.get_secret_value()),
         )
         record = await db.add_user(jsonable_encoder(user))
         background_tasks.add_task(
@@ -71,7 +72,7 @@ async def create_user(background_tasks: BackgroundTasks, payload: CreateUser = B
 @router.put("")
 async def update_user(
     payload: UpdateUserProfile = Body(...),
-    current_user: UserInDB = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
 ):
     """update current user"""
     try:
@@ -79,6 +80,8 @@ async def update_user(
         to_update = {k: v for k, v in payload.items() if v is not None}
 
         user = await db.update_user(current_user.id, to_update)
+        await invalidate_principal(current_user.id)
+
         return JSONResponse(
             content=jsonable_encoder(UpdateUserProfileOut(**user)),
             status_code=status.HTTP_200_OK,
@@ -94,48 +97,58 @@ async def update_user(
 @router.put("/password-change")
 async def update_user_password(
     payload: UpdateUserPassword = Body(...),
-    current_user: UserInDB = Depends(get_current_active_user),
+    current_user: Principal = Depends(get_current_active_user),
 ):
     """update current user's password"""
     try:
-        if not check_pw_hash(
+        # the cached principal carries no secrets, the password hash & wrapped dek are read from the database
+        record = await db.get_user_by_id(current_user.id)
+        if not record:
+            raise HTTPException(
+                detail="user not found",
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        user_in_db = UserInDB(**record)
+
+        if not await check_pw_hash_async(
             payload.current_password.get_secret_value(),
-            current_user.hashed_password.get_secret_value(),
+            user_in_db.hashed_password.get_secret_value(),
         ):
             raise HTTPException(
                 detail="invalid credentials",
                 status_code=status.HTTP_400_BAD_REQUEST,
             )
 
-        if check_pw_hash(
+        if await check_pw_hash_async(
             payload.new_password.get_secret_value(),
-            current_user.hashed_password.get_secret_value(),
+            user_in_db.hashed_password.get_secret_value(),
         ):
             raise HTTPException(
                 detail="current password and new password are the same",
                 status_code=status.HTTP_400_BAD_REQUEST,
             )
 
-        dek = decrypt_dek(
+        dek = await decrypt_dek_async(
             payload.current_password.get_secret_value(),
-            current_user.salt.get_secret_value(),
-            current_user.encrypted_dek.get_secret_value(),
+            user_in_db.salt.get_secret_value(),
+            user_in_db.encrypted_dek.get_secret_value(),
         )
 
-        _, encrypted_dek = generate_encrypted_dek(
+        _, encrypted_dek = await generate_encrypted_dek_async(
             payload.new_password.get_secret_value(),
-            current_user.salt.get_secret_value(),
+            user_in_db.salt.get_secret_value(),
             dek,
         )
 
         payload = jsonable_encoder(payload)
-        payload["hashed_password"] = hash_pw(payload.get("new_password"))
+        payload["hashed_password"] = await hash_pw_async(payload.get("new_password"))
         payload["encrypted_dek"] = encrypted_dek
         payload.pop("new_password")
         payload.pop("current_password")
 
         to_update = {k: v for k, v in payload.items() if v is not None}
         user = await db.update_user(current_user.id, to_update)
+        await invalidate_principal(current_user.id)
 
         # TODO: invalidate dek stored session cookie revoke jwt token
         return JSONResponse(
@@ -151,13 +164,12 @@ async def update_user_password(
 
 
 @router.get("")
-async def get_user(current_user: UserInDB = Depends(get_current_active_user)):
+async def get_user(current_user: Principal = Depends(get_current_active_user)):
     """get current user"""
     try:
-        user = await db.get_user_by_id(current_user.id)
-
+        # the authenticated principal is already up to date (it's invalidated on every user update)
         return JSONResponse(
-            content=jsonable_encoder(GetUserOut(**user)),
+            content=jsonable_encoder(GetUserOut(**current_user.dict(by_alias=True))),
             status_code=status.HTTP_200_OK,
         )
     except RuntimeError:
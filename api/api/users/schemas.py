@@ -5,22 +5,27 @@ from pydantic import BaseModel, EmailStr, SecretStr
 from pydantic.fields import Field
 
 
-class UserInDB(BaseModel):
-    """base class modelling the database entry for reference"""
+class Principal(BaseModel):
+    """the authenticated user, as cached between requests. the database entry without its secrets"""
 
     id: str = Field(None, alias="_id")
     avatar: str
     first_name: str
     last_name: str
     email: EmailStr
-    hashed_password: SecretStr
-    salt: SecretStr
-    encrypted_dek: SecretStr
     is_admin: bool
     is_active: bool
     created_at: datetime
 
 
+class UserInDB(Principal):
+    """base class modelling the database entry for reference"""
+
+    hashed_password: SecretStr
+    salt: SecretStr
+    encrypted_dek: SecretStr
+
+
 # schemas for "create user"
 class CreateUser(BaseModel):
     avatar: Optional[str] = "default.png"
@@ -1,10 +1,13 @@
-import aioredis
-import motor.motor_asyncio
+import asyncio
+
 from config import config
-from db.cache import CacheManager
+from db.cache import CacheManager, LocalCache
+from db.codec import make_codec
 from db.db import DatabaseManager
+from executor import CryptoExecutor
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from telemetry import MongoCommandTimer, RequestTimerMiddleware, start_event_loop_monitor, stop_event_loop_monitor
 
 # init app
 app = FastAPI(
@@ -19,22 +22,103 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Total-Count"],
 )
+app.add_middleware(RequestTimerMiddleware)
 
-# init database & cache
-DatabaseManager.init(
-    client=motor.motor_asyncio.AsyncIOMotorClient(config.MONGODB_URI, authSource="admin", serverSelectionTimeoutMS=3000)
+# database & cache clients are built in the startup hooks below, in each worker after gunicorn forked it.
+# nothing opens a socket or starts a thread at import, so the app can be preloaded in the master
+cache_codec = make_codec(config.REDIS_CRYPTO_KEY, config.CACHE_CODEC, config.CACHE_COMPRESS_THRESHOLD)
+cache_l1 = (
+    LocalCache(
+        max_items=config.CACHE_L1_MAX_ITEMS,
+        max_bytes=config.CACHE_L1_MAX_BYTES,
+        timeout=config.CACHE_L1_TIMEOUT,
+    )
+    if config.CACHE_L1_ENABLED
+    else None
 )
-CacheManager.init(
-    client=aioredis.from_url(config.REDIS_URI, encoding="utf-8", decode_responses=True),
-    default_timeout=config.CACHE_TIMEOUT,
-    crypto_key=config.REDIS_CRYPTO_KEY,
+
+
+# init crypto process pool (bcrypt hashing & kdf)
+CryptoExecutor.init(
+    max_workers=config.CRYPTO_POOL_SIZE,
+    max_queue=config.CRYPTO_QUEUE_SIZE,
+    queue_timeout=config.CRYPTO_QUEUE_TIMEOUT,
 )
 
 
+# app lifecycle. startup hooks run in order before the worker accepts requests, shutdown hooks after it stopped
+@app.on_event("startup")
+async def connect_database_and_cache():
+    # crypto processes are forked first, while the worker has no client threads running yet
+    await CryptoExecutor.warm_up()
+
+    DatabaseManager.connect(
+        config.MONGODB_URI,
+        authSource="admin",
+        serverSelectionTimeoutMS=3000,
+        maxPoolSize=config.MONGODB_MAX_POOL_SIZE,
+        minPoolSize=config.MONGODB_MIN_POOL_SIZE,
+        event_listeners=[MongoCommandTimer()],
+    )
+    CacheManager.connect(
+        config.REDIS_URI,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        default_timeout=config.CACHE_TIMEOUT,
+        codec=cache_codec,
+        l1=cache_l1,
+    )
+
+    # pre-warm the pools so the first requests after a deploy don't queue behind connection handshakes
+    await asyncio.gather(
+        DatabaseManager.warm_up(config.MONGODB_MIN_POOL_SIZE),
+        CacheManager.warm_up(config.REDIS_MIN_CONNECTIONS),
+    )
+
+
+@app.on_event("startup")
+async def ensure_database_indexes():
+    await DatabaseManager.ensure_indexes(config.MONGODB_DB)
+
+
+@app.on_event("startup")
+def start_cache_invalidation_listener():
+    CacheManager.start_invalidation_listener()
+
+
+@app.on_event("startup")
+def start_event_loop_lag_monitor():
+    start_event_loop_monitor()
+
+
+@app.on_event("shutdown")
+def stop_event_loop_lag_monitor():
+    stop_event_loop_monitor()
+
+
+@app.on_event("shutdown")
+async def stop_cache_invalidation_listener():
+    await CacheManager.stop_invalidation_listener()
+
+
+@app.on_event("shutdown")
+async def close_database_and_cache():
+    # drain: in-flight cache loads (which also read the database) finish & store their values before the pools close
+    await CacheManager.close(timeout=config.SHUTDOWN_DRAIN_TIMEOUT)
+    DatabaseManager.close()
+
+
+@app.on_event("shutdown")
+def shutdown_crypto_executor():
+    CryptoExecutor.shutdown()
+
+
 # load api routes
+from api.admin.routes import router as admin_router
 from api.health import router as health_router
 from api.login.routes import router as login_router
+from api.metrics import router as metrics_router
 from api.tasks.routes import router as task_router
 from api.users.routes import router as user_router
 
@@ -42,3 +126,5 @@ app.include_router(health_router, tags=["health"], prefix="/health")
 app.include_router(user_router, tags=["users"], prefix="/users")
 app.include_router(login_router, tags=["login"], prefix="/login")
 app.include_router(task_router, tags=["tasks"], prefix="/tasks")
+app.include_router(admin_router, tags=["admin"], prefix="/admin")
+app.include_router(metrics_router, tags=["metrics"], prefix="/metrics")
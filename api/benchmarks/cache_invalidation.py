@@ -0,0 +1,84 @@
+"""
+write path list-cache invalidation: SCAN + DEL (old) vs generation INCR (new)
+
+seeds redis with unrelated keys to grow the keyspace and times one user's invalidation at each size.
+the scan based delete grows with the total number of keys, the generation bump stays flat.
+
+usage (from the api folder, against a scratch redis db):
+    python -m benchmarks.cache_invalidation --redis-url redis://:<passwd>@localhost:6379/15
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aioredis
+from cryptography.fernet import Fernet
+from db.cache import CacheManager
+from db.codec import make_codec
+
+PREFIX = "bench:invalidation"
+
+
+async def seed(client, count: int, start: int):
+    async with client.pipeline(transaction=False) as pipe:
+        for i in range(start, count):
+            pipe.set(f"{PREFIX}:filler:{i}", "x")
+            if i % 10000 == 0:
+                await pipe.execute()
+        await pipe.execute()
+
+
+async def timed(coro_factory, rounds: int) -> float:
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await coro_factory()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+async def main(redis_url: str, sizes: list, rounds: int, pages: int):
+    client = aioredis.from_url(redis_url)
+    CacheManager.init(client=client, default_timeout=300, codec=make_codec(Fernet.generate_key().decode("utf-8")))
+
+    user = f"{PREFIX}:user"
+
+    async def populate_pages():
+        for page in range(pages):
+            await client.setex(f"({user})({page * 25},25)", 300, "x")
+
+    async def scan_delete():
+        await populate_pages()
+        await CacheManager.delete(f"({user})(*)", scan=True)
+
+    async def generation_bump():
+        await CacheManager.bump_generation(user)
+
+    print(f"{'keyspace':>10} {'scan delete (ms)':>18} {'generation incr (ms)':>22}")
+    seeded = 0
+    try:
+        for size in sorted(sizes):
+            await seed(client, size, seeded)
+            seeded = size
+
+            # scan_delete also re-populates the pages each round, time that separately and subtract it
+            populate = await timed(populate_pages, rounds)
+            scan = await timed(scan_delete, rounds) - populate
+            incr = await timed(generation_bump, rounds)
+            print(f"{size:>10} {scan:>18.3f} {incr:>22.3f}")
+    finally:
+        async for key in client.scan_iter(match=f"*{PREFIX}*", count=10000):
+            await client.delete(key)
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 500000])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=4, help="cached list pages per user")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.redis_url, args.sizes, args.rounds, args.pages))
@@ -0,0 +1,10 @@
+import os
+import uuid
+from base64 import urlsafe_b64encode
+
+
+def default_env():
+    """throwaway secrets for settings the app requires, so benchmarks run without a .env. set ones are kept"""
+    for key in ("SECRET_KEY", "REDIS_PASSWD", "MONGODB_USER", "MONGODB_PASSWD"):
+        os.environ.setdefault(key, uuid.uuid4().hex)
+    os.environ.setdefault("REDIS_CRYPTO_KEY", urlsafe_b64encode(os.urandom(32)).decode("utf-8"))
@@ -0,0 +1,363 @@
+"""
+end to end load benchmark: boots the app against in-memory mongodb/redis stand-ins (or local services), seeds users
+& tasks, then drives a weighted mix of login, list, get, update, create & delete requests at a fixed concurrency.
+
+reports throughput and p50/p95/p99 latency per operation. results can be written as json and compared against a
+stored baseline, the run exits with status 1 when an operation regressed by more than the tolerance.
+
+usage (from the api folder):
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.load --users 10 --tasks 50 --concurrency 32 --duration 30 --output baseline.json
+    python -m benchmarks.load --baseline baseline.json --tolerance 0.1
+
+    # local services instead of the in-memory stand-ins (a scratch mongodb database is created & dropped)
+    python -m benchmarks.load --mongo-uri mongodb://<user>:<passwd>@localhost:27017/ --redis-url redis://:<passwd>@localhost:6379/15
+
+    # an already running server, nothing is booted
+    python -m benchmarks.load --url http://localhost:8000
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+
+from benchmarks.common import default_env
+
+DEFAULT_MIX = {"login": 2, "list": 40, "get": 35, "update": 15, "create": 4, "delete": 4}
+STATUSES = ["To Do", "In The Works", "Needs Review", "Finished"]
+PRIORITIES = ["Critical", "High", "Medium", "Low"]
+
+
+def boot_app(mongo_uri: str = None, redis_url: str = None, mongo_db: str = None):
+    """init the database & cache managers with stand-ins before the app is imported, its own init is then a no-op"""
+    default_env()
+    if mongo_db:
+        os.environ["MONGODB_DB"] = mongo_db
+
+    from config import config
+    from db.cache import CacheManager, LocalCache
+    from db.codec import make_codec
+    from db.db import DatabaseManager
+
+    if mongo_uri:
+        import motor.motor_asyncio
+
+        mongo_client = motor.motor_asyncio.AsyncIOMotorClient(mongo_uri, serverSelectionTimeoutMS=3000)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+
+        mongo_client = AsyncMongoMockClient()
+
+    if redis_url:
+        import aioredis
+
+        redis_client = aioredis.from_url(redis_url)
+    else:
+        import fakeredis.aioredis
+
+        redis_client = fakeredis.aioredis.FakeRedis()
+
+    DatabaseManager.init(client=mongo_client)
+    CacheManager.init(
+        client=redis_client,
+        default_timeout=config.CACHE_TIMEOUT,
+        codec=make_codec(config.REDIS_CRYPTO_KEY, config.CACHE_CODEC, config.CACHE_COMPRESS_THRESHOLD),
+        l1=LocalCache(
+            max_items=config.CACHE_L1_MAX_ITEMS,
+            max_bytes=config.CACHE_L1_MAX_BYTES,
+            timeout=config.CACHE_L1_TIMEOUT,
+        )
+        if config.CACHE_L1_ENABLED
+        else None,
+    )
+
+    from app import app
+
+    return app, mongo_client, config.MONGODB_DB
+
+
+class Session:
+    """a seeded user: credentials, current token & dek and the ids of its tasks"""
+
+    def __init__(self, email: str, password: str) -> None:
+        self.email = email
+        self.password = password
+        self.token = None
+        self.dek = None
+        self.task_ids = []
+
+    @property
+    def headers(self) -> dict:
+        # the dek cookie is set per request, the shared client's cookie jar would mix users up
+        return {"Authorization": f"Bearer {self.token}", "Cookie": f"dek={self.dek}"}
+
+
+def make_task(rng: random.Random) -> dict:
+    now = datetime(2021, 11, 1, 9, 30) + timedelta(minutes=rng.randrange(60 * 24 * 90))
+    return {
+        "task_data": {
+            "title": f"task {rng.randrange(10 ** 6)}",
+            "topic": rng.choice(["work", "home", "errands", "reading"]),
+            "priority": rng.choice(PRIORITIES),
+            "status": rng.choice(STATUSES),
+            "description": "lorem ipsum dolor sit amet " * rng.randint(1, 12),
+            "estimate": rng.randint(1, 13),
+            "starts": now.isoformat(),
+            "due": (now + timedelta(days=rng.randint(1, 30))).isoformat(),
+            "comments": [{"comment": f"comment {i}"} for i in range(rng.randint(0, 4))],
+            "todo_items": [{"item": f"item {i}", "is_done": rng.random() < 0.5} for i in range(rng.randint(0, 6))],
+        }
+    }
+
+
+# operations. each returns the response, the runner times it
+async def login(client: httpx.AsyncClient, session: Session, rng: random.Random) -> httpx.Response:
+    response = await client.post("/login", data={"username": session.email, "password": session.password})
+    if response.status_code == 200:
+        session.token = response.json()["access_token"]
+        session.dek = response.cookies.get("dek")
+        client.cookies.clear()
+    return response
+
+
+async def list_tasks(client: httpx.AsyncClient, session: Session, rng: random.Random) -> httpx.Response:
+    return await client.get("/tasks", headers=session.headers, params={"limit": 25})
+
+
+async def get_task(client: httpx.AsyncClient, session: Session, rng: random.Random) -> httpx.Response:
+    if not session.task_ids:
+        return await create_task(client, session, rng)
+    return await client.get(f"/tasks/{rng.choice(session.task_ids)}", headers=session.headers)
+
+
+async def update_task(client: httpx.AsyncClient, session: Session, rng: random.Random) -> httpx.Response:
+    if not session.task_ids:
+        return await create_task(client, session, rng)
+    payload = {"task_data": {"status": rng.choice(STATUSES), "priority": rng.choice(PRIORITIES)}}
+    return await client.put(f"/tasks/{rng.choice(session.task_ids)}", headers=session.headers, json=payload)
+
+
+async def create_task(client: httpx.AsyncClient, session: Session, rng: random.Random) -> httpx.Response:
+    response = await client.post("/tasks", headers=session.headers, json=make_task(rng))
+    if response.status_code == 201:
+        session.task_ids.append(response.json()["_id"])
+    return response
+
+
+async def delete_task(client: httpx.AsyncClient, session: Session, rng: random.Random) -> httpx.Response:
+    if not session.task_ids:
+        return await create_task(client, session, rng)
+    id = session.task_ids.pop(rng.randrange(len(session.task_ids)))
+    return await client.delete(f"/tasks/{id}", headers=session.headers)
+
+
+OPERATIONS = {
+    "login": login,
+    "list": list_tasks,
+    "get": get_task,
+    "update": update_task,
+    "create": create_task,
+    "delete": delete_task,
+}
+
+
+async def seed(client: httpx.AsyncClient, users: int, tasks: int, rng: random.Random) -> list:
+    run = uuid.uuid4().hex[:8]
+
+    async def seed_user(i: int) -> Session:
+        session = Session(f"bench-{run}-{i}@example.com", uuid.uuid4().hex)
+        response = await client.post(
+            "/users",
+            json={"first_name": "bench", "last_name": str(i), "email": session.email, "password": session.password},
+        )
+        response.raise_for_status()
+        (await login(client, session, rng)).raise_for_status()
+
+        for start in range(0, tasks, 100):
+            payload = [make_task(rng) for _ in range(min(100, tasks - start))]
+            response = await client.post("/tasks/bulk", headers=session.headers, json=payload)
+            response.raise_for_status()
+            session.task_ids.extend(result["id"] for result in response.json() if result["status"] == 201)
+        return session
+
+    return await asyncio.gather(*(seed_user(i) for i in range(users)))
+
+
+async def drive(
+    client: httpx.AsyncClient, sessions: list, mix: dict, concurrency: int, duration: float, warmup: float, seed: int
+) -> dict:
+    names, weights = list(mix), list(mix.values())
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    client_errors = {name: 0 for name in names}
+
+    started = time.perf_counter()
+    measure_from, deadline = started + warmup, started + warmup + duration
+
+    async def worker(rng: random.Random):
+        while time.perf_counter() < deadline:
+            session = rng.choice(sessions)
+            name = rng.choices(names, weights)[0]
+            sent = time.perf_counter()
+            try:
+                status_code = (await OPERATIONS[name](client, session, rng)).status_code
+            except httpx.HTTPError:
+                status_code = None
+            elapsed = time.perf_counter() - sent
+
+            if sent < measure_from:
+                continue
+            samples[name].append(elapsed)
+            if status_code is None or status_code >= 500:
+                errors[name] += 1
+            elif status_code >= 400:
+                # mostly races between workers sharing a user, e.g. reading a task another one just deleted
+                client_errors[name] += 1
+
+    await asyncio.gather(*(worker(random.Random(seed + i)) for i in range(concurrency)))
+    window = time.perf_counter() - measure_from
+
+    operations = {name: summarize(samples[name], errors[name], client_errors[name], window) for name in names}
+    everything = [sample for name in names for sample in samples[name]]
+    total = summarize(everything, sum(errors.values()), sum(client_errors.values()), window)
+    return {"operations": operations, "total": total, "window": window}
+
+
+def summarize(samples: list, errors: int, client_errors: int, window: float) -> dict:
+    summary = {"requests": len(samples), "errors": errors, "client_errors": client_errors}
+    summary["throughput"] = len(samples) / window if window > 0 else 0.0
+    if len(samples) >= 2:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+        summary.update(
+            mean_ms=statistics.mean(samples) * 1000, p50_ms=cuts[49] * 1000, p95_ms=cuts[94] * 1000, p99_ms=cuts[98] * 1000
+        )
+    return summary
+
+
+def report(results: dict):
+    print(f"{'operation':>10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    rows = list(results["operations"].items()) + [("total", results["total"])]
+    for name, summary in rows:
+        print(
+            f"{name:>10} {summary['requests']:>9} {summary['errors']:>7} {summary['throughput']:>9.1f} "
+            f"{summary.get('p50_ms', 0):>9.2f} {summary.get('p95_ms', 0):>9.2f} {summary.get('p99_ms', 0):>9.2f}"
+        )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """operations slower (p95) or with lower throughput than the baseline by more than the tolerance"""
+    regressions = []
+    current = dict(results["operations"], total=results["total"])
+    previous = dict(baseline["operations"], total=baseline["total"])
+
+    print(f"\n{'operation':>10} {'req/s':>18} {'p95 (ms)':>22}")
+    for name, summary in current.items():
+        base = previous.get(name)
+        if not base or "p95_ms" not in base or "p95_ms" not in summary:
+            continue
+
+        throughput_change = summary["throughput"] / base["throughput"] - 1 if base["throughput"] else 0.0
+        latency_change = summary["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0.0
+        flag = ""
+        if throughput_change < -tolerance or latency_change > tolerance or summary["errors"] > base["errors"]:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:>10} {base['throughput']:>8.1f} {throughput_change:>+8.1%} "
+            f"{base['p95_ms']:>10.2f} {latency_change:>+10.1%}{flag}"
+        )
+    return regressions
+
+
+def parse_mix(value: str) -> dict:
+    """parse "list=40,get=35,..." to weights, operations not listed are not run"""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+async def main(args) -> int:
+    mongo_client = None
+    if args.url:
+        transport = {"base_url": args.url}
+    else:
+        app, mongo_client, mongo_db = boot_app(args.mongo_uri, args.redis_url, args.mongo_db if args.mongo_uri else None)
+        await app.router.startup()
+        transport = {"app": app, "base_url": "http://bench"}
+
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(timeout=30, limits=limits, **transport) as client:
+            seeded = time.perf_counter()
+            sessions = await seed(client, args.users, args.tasks, rng)
+            print(f"seeded {args.users} users x {args.tasks} tasks in {time.perf_counter() - seeded:.1f}s")
+
+            results = await drive(client, sessions, args.mix, args.concurrency, args.duration, args.warmup, args.seed)
+    finally:
+        if not args.url:
+            await app.router.shutdown()
+            if args.mongo_uri:
+                await mongo_client.drop_database(mongo_db)
+
+    results["config"] = {
+        "target": args.url or ("local" if args.mongo_uri else "in-memory"),
+        "users": args.users,
+        "tasks": args.tasks,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "mix": args.mix,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nresults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nregressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of booting the app")
+    parser.add_argument("--mongo-uri", help="local mongodb instead of the in-memory stand-in")
+    parser.add_argument("--mongo-db", default="jiro_bench", help="scratch database used with --mongo-uri")
+    parser.add_argument("--redis-url", help="local redis instead of the in-memory stand-in")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--tasks", type=int, default=50, help="tasks seeded per user")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="weights, e.g. list=40,get=35,update=15")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as json")
+    parser.add_argument("--baseline", help="compare against results written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed p95 / throughput change")
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(args)))
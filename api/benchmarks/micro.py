@@ -0,0 +1,196 @@
+"""
+microbenchmarks for the per-request & per-login hot paths in api/security.py and api/tasks/routes.py:
+jwt create/verify, bcrypt hash/check, dek unwrapping (bcrypt kdf), task_data sealing & unsealing at several sizes,
+task validate & encode, the mergedeep based task_data merge (still used for legacy tasks) and the field level
+envelope PUT /tasks/{id} writes & every task read decrypts.
+
+each case is timed with timeit (gc off): the loop count is picked by autorange, then the loop is repeated and
+the median per call is reported with the interquartile range as a spread. inputs are fixed and seeded so runs compare.
+results can be written as json & compared against a baseline, the run exits with status 1 on regressions.
+
+usage (from the api folder):
+    python -m benchmarks.micro --output micro.json
+    python -m benchmarks.micro --filter envelope --baseline micro.json --tolerance 0.05
+"""
+import argparse
+import json
+import platform
+import random
+import re
+import statistics
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+from benchmarks.common import default_env
+
+default_env()
+
+import app  # noqa: F401, the api modules import from app, load it before them
+from fastapi.encoders import jsonable_encoder
+
+from api.security import (
+    check_pw_hash,
+    create_access_token,
+    decrypt_dek,
+    generate_encrypted_dek,
+    hash_pw,
+    verify_access_token,
+)
+from api.tasks.envelope import seal, seal_update, unseal
+from api.tasks.routes import _merge_task_data, serialize_task
+from api.tasks.schemas import TaskInDBWrapped
+
+PAYLOAD_SIZES = [256, 4096, 65536]
+
+
+def make_task_data(rng: random.Random, size: int = 512, comments: int = 5, todo_items: int = 5) -> dict:
+    now = datetime(2021, 11, 1, 9, 30, 15, 123456)
+    task_data = {
+        "title": "benchmark task",
+        "topic": "benchmarks",
+        "priority": "High",
+        "status": "In The Works",
+        "description": "",
+        "estimate": 5,
+        "starts": now.isoformat(),
+        "due": (now + timedelta(days=7)).isoformat(),
+        "comments": [
+            {"id": str(uuid.UUID(int=rng.getrandbits(128))), "comment": f"comment {i}", "created": now.isoformat()}
+            for i in range(comments)
+        ],
+        "todo_items": [
+            {
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "item": f"item {i}",
+                "is_done": bool(i % 2),
+                "created": now.isoformat(),
+            }
+            for i in range(todo_items)
+        ],
+    }
+    # pad the description so the json payload is about `size` bytes
+    padding = size - len(json.dumps(task_data))
+    task_data["description"] = "".join(rng.choice("abcdefghij ") for _ in range(max(0, padding)))
+    return task_data
+
+
+def make_cases(rng: random.Random) -> dict:
+    password = "correct horse battery staple"
+    pw_hash = hash_pw(password)
+    salt, encrypted_dek = generate_encrypted_dek(password)
+    dek = decrypt_dek(password, salt, encrypted_dek)
+    token = create_access_token({"_id": f"{1:024x}"})
+
+    cases = {
+        "jwt.create_access_token": lambda: create_access_token({"_id": f"{1:024x}"}),
+        "jwt.verify_access_token": lambda: verify_access_token(token),
+        "bcrypt.hash_pw": lambda: hash_pw(password),
+        "bcrypt.check_pw_hash": lambda: check_pw_hash(password, pw_hash),
+        "kdf.decrypt_dek": lambda: decrypt_dek(password, salt, encrypted_dek),
+    }
+
+    for size in PAYLOAD_SIZES:
+        task_data = make_task_data(rng, size)
+        sealed = seal(dek, task_data)
+        cases[f"envelope.seal[{size}]"] = lambda task_data=task_data: seal(dek, task_data)
+        cases[f"envelope.unseal[{size}]"] = lambda sealed=sealed: unseal(dek, sealed)
+
+    now = datetime(2021, 11, 1, 9, 30, 15, 123456).isoformat()
+    task = {
+        "_id": f"{2:024x}",
+        "task_data": make_task_data(rng),
+        "created_by": f"{1:024x}",
+        "created": now,
+        "modified": now,
+        "archived": False,
+    }
+    cases["schema.validate_and_encode"] = lambda: jsonable_encoder(TaskInDBWrapped(**task))
+    cases["schema.serialize_task"] = lambda: serialize_task(task)
+
+    stored = make_task_data(rng, comments=20, todo_items=20)
+    comment = {"id": str(uuid.UUID(int=rng.getrandbits(128))), "comment": "one more", "created": now}
+    update = {"status": "Finished", "comments": [comment], "todo_items": stored["todo_items"][:10]}
+    cases["merge.task_data"] = lambda: _merge_task_data(stored, update)
+
+    sealed = seal(dek, stored)
+    cases["envelope.seal_update"] = lambda: seal_update(dek, update)
+    cases["envelope.unseal"] = lambda: unseal(dek, sealed)
+    return cases
+
+
+def measure(func, repeat: int) -> dict:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    samples = sorted(t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number))
+    q1, _, q3 = statistics.quantiles(samples, n=4, method="inclusive")
+    return {"median_us": statistics.median(samples), "min_us": samples[0], "iqr_us": q3 - q1, "loops": number}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """cases whose median got slower than the baseline's by more than the tolerance (and more than their spread)"""
+    regressions = []
+    print(f"\n{'case':>34} {'baseline (us)':>14} {'change':>9}")
+    for name, result in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if not base:
+            continue
+
+        change = result["median_us"] / base["median_us"] - 1
+        # slower by less than the two runs' spread is noise, not a regression
+        noisy = result["median_us"] - base["median_us"] <= result["iqr_us"] + base["iqr_us"]
+        flag = ""
+        if change > tolerance and not noisy:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:>34} {base['median_us']:>14.2f} {change:>+9.1%}{flag}")
+    return regressions
+
+
+def main(args) -> int:
+    cases = make_cases(random.Random(args.seed))
+    if args.filter:
+        cases = {name: func for name, func in cases.items() if re.search(args.filter, name)}
+
+    results = {"cases": {}}
+    print(f"{'case':>34} {'median (us)':>12} {'iqr (us)':>10} {'min (us)':>10} {'loops':>7}")
+    for name, func in cases.items():
+        result = measure(func, args.repeat)
+        results["cases"][name] = result
+        print(
+            f"{name:>34} {result['median_us']:>12.2f} {result['iqr_us']:>10.2f} "
+            f"{result['min_us']:>10.2f} {result['loops']:>7}"
+        )
+
+    results["config"] = {
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nresults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nregressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", help="only run cases matching this regex")
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as json")
+    parser.add_argument("--baseline", help="compare against results written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="allowed median slowdown")
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -0,0 +1,84 @@
+"""
+task list page encoding: pydantic model + jsonable_encoder + JSONResponse (old) vs precompiled serializer + orjson (new)
+
+usage (from the api folder):
+    python -m benchmarks.serialization --page-size 25 --comments 10 --todo-items 10
+"""
+import argparse
+import json
+import statistics
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from api.serializers import compile_serializer, serialize_many
+from api.tasks.schemas import TaskInDBWrapped
+
+
+def make_page(page_size: int, comments: int, todo_items: int) -> list:
+    now = datetime(2021, 11, 1, 9, 30, 15, 123456)
+    return [
+        {
+            "_id": f"{i:024x}",
+            "task_data": {
+                "title": f"task {i}",
+                "topic": "benchmarks",
+                "priority": "High",
+                "status": "In The Works",
+                "description": "lorem ipsum dolor sit amet " * 8,
+                "estimate": 5,
+                "starts": now.isoformat(),
+                "due": (now + timedelta(days=7)).isoformat(),
+                "comments": [
+                    {"id": str(uuid.UUID(int=j)), "comment": f"comment {j}", "created": now.isoformat()}
+                    for j in range(comments)
+                ],
+                "todo_items": [
+                    {"id": str(uuid.UUID(int=j)), "item": f"item {j}", "is_done": bool(j % 2), "created": now.isoformat()}
+                    for j in range(todo_items)
+                ],
+            },
+            "created_by": f"{0:024x}",
+            "created": now.isoformat(),
+            "modified": now.isoformat(),
+            "archived": False,
+        }
+        for i in range(page_size)
+    ]
+
+
+def main(page_size: int, comments: int, todo_items: int, repeat: int):
+    page = make_page(page_size, comments, todo_items)
+    serialize_task = compile_serializer(TaskInDBWrapped)
+
+    def old():
+        return JSONResponse(content=[jsonable_encoder(TaskInDBWrapped(**task)) for task in page]).body
+
+    def new():
+        return ORJSONResponse(content=serialize_many(serialize_task, page)).body
+
+    # both paths must produce the same document
+    assert json.loads(old()) == json.loads(new()), "serializers disagree"
+
+    for name, func in (("pydantic + json", old), ("compiled + orjson", new)):
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        samples = [t / number * 1000 for t in timer.repeat(repeat=repeat, number=number)]
+        print(
+            f"{name:>20}: median {statistics.median(samples):8.3f} ms/page, "
+            f"min {min(samples):8.3f} ms/page, {len(func())} bytes"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-size", type=int, default=25)
+    parser.add_argument("--comments", type=int, default=10)
+    parser.add_argument("--todo-items", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    main(args.page_size, args.comments, args.todo_items, args.repeat)
@@ -0,0 +1,129 @@
+"""
+gunicorn worker count sweep: boots the app under gunicorn (gunicorn.conf.py, preloaded) with each worker count,
+drives it with the load benchmark and reports throughput, latency & memory per count. memory is the total rss of
+the master, its workers and their crypto processes, sampled after the run.
+
+the workers need a mongodb & redis they share, configured through .env / the environment as usual.
+pin the run to the cpus you want to size for, e.g. with taskset or a container cpu limit.
+
+usage (from the api folder):
+    python -m benchmarks.workers --workers 1 2 4 8 --concurrency 64 --duration 30 --output workers.json
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from worker import rss_bytes
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def descendants(pid: int) -> list:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the process name may contain spaces, ppid is the second field after it
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    found, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child)
+    return found
+
+
+def wait_until_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=2) as response:
+                if response.status == 200:
+                    return None
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"gunicorn didn't get ready at {url} within {timeout}s")
+
+
+def run(workers: int, args, log) -> dict:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    gunicorn = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--workers", str(workers)]
+        + ["--bind", f"127.0.0.1:{port}", "app:app"],
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        started = time.monotonic()
+        wait_until_ready(url, args.boot_timeout)
+        ready = time.monotonic() - started
+
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.load", "--url", url, "--output", output.name]
+                + ["--users", str(args.users), "--tasks", str(args.tasks), "--concurrency", str(args.concurrency)]
+                + ["--duration", str(args.duration), "--warmup", str(args.warmup), "--seed", str(args.seed)],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            results = json.load(output)
+
+        rss = sum(rss_bytes(pid) for pid in [gunicorn.pid] + descendants(gunicorn.pid))
+        return {"workers": workers, "ready_s": ready, "rss_mb": rss / 2 ** 20, "total": results["total"]}
+    finally:
+        gunicorn.send_signal(signal.SIGTERM)
+        gunicorn.wait(timeout=60)
+
+
+def main(args):
+    results = []
+    print(f"{'workers':>8} {'ready (s)':>10} {'req/s':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'rss (MB)':>9}")
+    with open(args.log, "ab") as log:
+        for workers in args.workers:
+            result = run(workers, args, log)
+            results.append(result)
+            total = result["total"]
+            print(
+                f"{workers:>8} {result['ready_s']:>10.1f} {total['throughput']:>9.1f} {total.get('p50_ms', 0):>9.2f} "
+                f"{total.get('p95_ms', 0):>9.2f} {total.get('p99_ms', 0):>9.2f} {result['rss_mb']:>9.0f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cpus": len(os.sched_getaffinity(0)), "runs": results}, f, indent=2)
+        print(f"\nresults written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--boot-timeout", type=float, default=60)
+    parser.add_argument("--log", default="benchmark-workers.log", help="gunicorn output")
+    parser.add_argument("--output", help="write results as json")
+    args = parser.parse_args()
+
+    main(args)
@@ -9,9 +9,33 @@ class Config(BaseSettings):
     """base class used to configure the app"""
 
     CACHE_TIMEOUT: int = Field(300, env="CACHE_TIMEOUT")
+    CACHE_CODEC: str = Field("binary", env="CACHE_CODEC")
+    CACHE_COMPRESS_THRESHOLD: int = Field(1024, env="CACHE_COMPRESS_THRESHOLD")
+    CACHE_L1_ENABLED: bool = Field(False, env="CACHE_L1_ENABLED")
+    CACHE_L1_TIMEOUT: int = Field(5, env="CACHE_L1_TIMEOUT")
+    CACHE_L1_MAX_ITEMS: int = Field(2048, env="CACHE_L1_MAX_ITEMS")
+    CACHE_L1_MAX_BYTES: int = Field(32 * 1024 * 1024, env="CACHE_L1_MAX_BYTES")
     SECRET_KEY: str = Field(..., env="SECRET_KEY")
     ACCESS_TOKEN_EXPIRE_TIMEOUT: int = Field(30, env="ACCESS_TOKEN_EXPIRE_TIMEOUT")
+
+    TASKS_BULK_MAX_ITEMS: int = Field(500, env="TASKS_BULK_MAX_ITEMS")
+    TASKS_EXPORT_BATCH_SIZE: int = Field(100, env="TASKS_EXPORT_BATCH_SIZE")
+    TASKS_SEARCH_MAX_CANDIDATES: int = Field(1000, env="TASKS_SEARCH_MAX_CANDIDATES")
+
+    PRINCIPAL_CACHE_TIMEOUT: int = Field(60, env="PRINCIPAL_CACHE_TIMEOUT")
+    PRINCIPAL_CACHE_L1_TIMEOUT: int = Field(10, env="PRINCIPAL_CACHE_L1_TIMEOUT")
+    PRINCIPAL_CACHE_MAX_ITEMS: int = Field(4096, env="PRINCIPAL_CACHE_MAX_ITEMS")
+
+    CIPHER_CACHE_TIMEOUT: int = Field(300, env="CIPHER_CACHE_TIMEOUT")
+    CIPHER_CACHE_MAX_ITEMS: int = Field(1024, env="CIPHER_CACHE_MAX_ITEMS")
     PORT: int = Field(8000, env="PORT")
+    WORKERS: int = Field(0, env="WORKERS")
+    MAX_REQUESTS: int = Field(10000, env="MAX_REQUESTS")
+    MAX_REQUESTS_JITTER: int = Field(1000, env="MAX_REQUESTS_JITTER")
+
+    CRYPTO_POOL_SIZE: int = Field(2, env="CRYPTO_POOL_SIZE")
+    CRYPTO_QUEUE_SIZE: int = Field(64, env="CRYPTO_QUEUE_SIZE")
+    CRYPTO_QUEUE_TIMEOUT: float = Field(5.0, env="CRYPTO_QUEUE_TIMEOUT")
 
     REDIS_DB: int = Field(0, env="REDIS_DB")
     REDIS_CRYPTO_KEY: str = Field(..., env="REDIS_CRYPTO_KEY")
@@ -20,6 +44,8 @@ class Config(BaseSettings):
     REDIS_HOST: str = Field("localhost", env="REDIS_HOST")
     REDIS_PORT: int = Field(6379, env="REDIS_PORT")
     REDIS_URI: Optional[str]
+    REDIS_MAX_CONNECTIONS: int = Field(64, env="REDIS_MAX_CONNECTIONS")
+    REDIS_MIN_CONNECTIONS: int = Field(4, env="REDIS_MIN_CONNECTIONS")
 
     MONGODB_DB: str = Field("jiro_db", env="MONGODB_DB")
     MONGODB_COLLECTION_TASKS: str = Field("tasks", env="MONGODB_COLLECTION_TASKS")
@@ -30,6 +56,12 @@ class Config(BaseSettings):
     MONGODB_HOST: str = Field("localhost", env="MONGODB_HOST")
     MONGODB_PORT: int = Field(27017, env="MONGODB_PORT")
     MONGODB_URI: Optional[str]
+    MONGODB_MAX_POOL_SIZE: int = Field(100, env="MONGODB_MAX_POOL_SIZE")
+    MONGODB_MIN_POOL_SIZE: int = Field(4, env="MONGODB_MIN_POOL_SIZE")
+
+    SHUTDOWN_DRAIN_TIMEOUT: float = Field(10.0, env="SHUTDOWN_DRAIN_TIMEOUT")
+    HEALTH_PROBE_TIMEOUT: float = Field(1.0, env="HEALTH_PROBE_TIMEOUT")
+    HEALTH_PROBE_INTERVAL: float = Field(2.0, env="HEALTH_PROBE_INTERVAL")
 
     class Config:
         case_sensitive = True
@@ -1,9 +1,97 @@
+import asyncio
 import json
-from typing import Any
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from typing import Any, Awaitable, Callable, List
 
+import aioredis
 from aioredis import Redis
 from aioredis.exceptions import ConnectionError
-from cryptography.fernet import Fernet
+from fastapi.logger import logger
+
+from telemetry import CACHE_OPERATIONS
+
+from .codec import CacheCodec, CacheCodecError
+
+
+class LocalCache:
+    """bounded in-process lru cache with ttl and a memory budget"""
+
+    def __init__(self, max_items: int, max_bytes: int, timeout: float) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, size, expires = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, size: int, timeout: float = None):
+        if size > self.max_bytes:
+            return None
+
+        if key in self._entries:
+            self._remove(key)
+
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        self._entries[key] = (value, size, time.monotonic() + timeout)
+        self._bytes += size
+
+        while len(self._entries) > self.max_items or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key: str, pattern: bool = False):
+        keys = [k for k in self._entries if fnmatchcase(k, key)] if pattern else [key]
+        for k in keys:
+            if k in self._entries:
+                self._remove(k)
+                self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._entries),
+            "bytes": self._bytes,
+            "max_items": self.max_items,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
 
 
 class CacheManager:
@@ -12,53 +100,136 @@ class CacheManager:
     _initialized = False
     _client = None
     _default_timeout = None
-    _cipher = None
+    _codec = None
+
+    # optional per-worker l1 tier, kept coherent across workers through redis pub/sub.
+    # other in-process caches keyed like redis can register to get the same invalidations
+    _l1 = None
+    _local_caches = []
+    _origin = None
+    _invalidation_channel = "cache:invalidate"
+    _invalidation_listener = None
+
+    # single-flight loads: in-flight loads per key in this worker, and a short redis lock across workers
+    _inflight = {}
+    _lock_timeout = 5
+    _refresh_beta = 1.0
 
     @classmethod
-    def init(cls, client: Redis, default_timeout: int, crypto_key: str):
+    def init(cls, client: Redis, default_timeout: int, codec: CacheCodec, l1: LocalCache = None):
         if cls._initialized:
             return None
 
         cls._initialized = True
         cls._client = client
         cls._default_timeout = default_timeout
-        cls._cipher = Fernet(crypto_key.encode("utf-8"))
+        cls._codec = codec
+        cls._l1 = l1
+        cls._origin = uuid.uuid4().hex
+        if l1 is not None and l1 not in cls._local_caches:
+            cls._local_caches.append(l1)
+
+    @classmethod
+    def connect(cls, uri: str, max_connections: int, **kwargs):
+        """
+        build the client & init with it (see `init` for kwargs). called from the worker's startup, after gunicorn
+        forked it, so each worker gets its own pool & origin. a no-op if already initialized
+        """
+        if cls._initialized:
+            return None
+
+        cls.init(client=aioredis.from_url(uri, max_connections=max_connections), **kwargs)
 
     @staticmethod
-    async def ping() -> bool:
+    async def warm_up(connections: int):
+        """open `connections` pooled connections up front, so the first requests don't pay for the handshakes"""
+        if connections <= 0:
+            return None
         try:
-            return await CacheManager._client.ping()
+            _ = await asyncio.gather(*(CacheManager._client.ping() for _ in range(connections)))
         except ConnectionError:
+            pass
+
+    @classmethod
+    async def close(cls, timeout: float):
+        """drain: let in-flight loads finish (up to `timeout`) so their values are stored, then close the pool"""
+        if cls._inflight:
+            _ = await asyncio.wait(list(cls._inflight.values()), timeout=timeout)
+
+        if cls._client is not None:
+            try:
+                await cls._client.close()
+                await cls._client.connection_pool.disconnect()
+            except ConnectionError:
+                pass
+        cls._client = None
+        cls._initialized = False
+
+    @classmethod
+    def register_local_cache(cls, cache: LocalCache):
+        cls._local_caches.append(cache)
+
+    @staticmethod
+    async def ping(timeout: float) -> bool:
+        try:
+            return await asyncio.wait_for(CacheManager._client.ping(), timeout=timeout)
+        except (ConnectionError, asyncio.TimeoutError):
             return False
 
     @staticmethod
-    async def store(key: str, value: str, timeout: int = None) -> bool:
+    async def store(key: str, value: str, timeout: int = None, invalidate: bool = True) -> bool:
+        """
+        store a value in redis (& l1). `invalidate` evicts the key from the other workers' l1, which writes need.
+        fills of a value just read from the database pass False: a write that made other copies stale published
+        its own invalidation
+        """
         if timeout is None:
             timeout = CacheManager._default_timeout
         try:
-            return await CacheManager._client.setex(
-                key,
-                timeout,
-                CacheManager._cipher.encrypt(json.dumps(value).encode("utf-8")),
-            )
+            serialized = CacheManager._codec.dumps(value)
+            stored = await CacheManager._client.setex(key, timeout, CacheManager._codec.seal(serialized))
+            if CacheManager._l1 is not None:
+                CacheManager._l1.set(key, serialized, len(serialized), timeout)
+                if invalidate:
+                    await CacheManager._publish_invalidation(key)
+            return stored
         except ConnectionError:
             return False
 
     @staticmethod
     async def fetch(key: str) -> Any:
+        if CacheManager._l1 is not None:
+            serialized = CacheManager._l1.get(key)
+            if serialized is not None:
+                CACHE_OPERATIONS.labels("l1", "hit").inc()
+                return CacheManager._codec.loads(serialized)
+            CACHE_OPERATIONS.labels("l1", "miss").inc()
+
         try:
             value = await CacheManager._client.get(key)
             if not value:
+                CACHE_OPERATIONS.labels("redis", "miss").inc()
                 return None
 
-            return json.loads(CacheManager._cipher.decrypt(value.encode("utf-8")))
-        except ConnectionError:
+            serialized = CacheManager._codec.unseal(value)
+            if CacheManager._l1 is not None:
+                CacheManager._l1.set(key, serialized, len(serialized))
+
+            CACHE_OPERATIONS.labels("redis", "hit").inc()
+            return CacheManager._codec.loads(serialized)
+        except (ConnectionError, CacheCodecError):
+            CACHE_OPERATIONS.labels("redis", "error").inc()
             return None
 
     @staticmethod
     async def delete(key: str, scan: bool = False) -> bool:
         deleted = 0
         try:
+            if CacheManager._local_caches:
+                for cache in CacheManager._local_caches:
+                    cache.invalidate(key, pattern=scan)
+                await CacheManager._publish_invalidation(key, pattern=scan)
+
             if scan:
                 async for k in CacheManager._client.scan_iter(match=key):
                     deleted += await CacheManager._client.delete(k)
@@ -68,3 +239,296 @@ class CacheManager:
             return True if deleted else False
         except ConnectionError:
             return False
+
+    @staticmethod
+    async def delete_many(keys: List[str]) -> bool:
+        if not keys:
+            return False
+        try:
+            if CacheManager._local_caches:
+                for key in keys:
+                    for cache in CacheManager._local_caches:
+                        cache.invalidate(key)
+                await CacheManager._publish_invalidation(*keys)
+
+            deleted = await CacheManager._client.delete(*keys)
+            return True if deleted else False
+        except ConnectionError:
+            return False
+
+    @staticmethod
+    async def fetch_many(keys: List[str]) -> List[Any]:
+        """fetch many keys in one round trip (MGET), None for the missing ones"""
+        values = [None] * len(keys)
+        remote = []
+        for i, key in enumerate(keys):
+            serialized = CacheManager._l1.get(key) if CacheManager._l1 is not None else None
+            if serialized is not None:
+                values[i] = CacheManager._codec.loads(serialized)
+            else:
+                remote.append(i)
+
+        if CacheManager._l1 is not None:
+            CACHE_OPERATIONS.labels("l1", "hit").inc(len(keys) - len(remote))
+            CACHE_OPERATIONS.labels("l1", "miss").inc(len(remote))
+        if not remote:
+            return values
+
+        try:
+            fetched = await CacheManager._client.mget([keys[i] for i in remote])
+        except ConnectionError:
+            CACHE_OPERATIONS.labels("redis", "error").inc(len(remote))
+            return values
+
+        hits = misses = errors = 0
+        for i, value in zip(remote, fetched):
+            if not value:
+                misses += 1
+                continue
+
+            try:
+                serialized = CacheManager._codec.unseal(value)
+            except CacheCodecError:
+                errors += 1
+                continue
+
+            if CacheManager._l1 is not None:
+                CacheManager._l1.set(keys[i], serialized, len(serialized))
+            values[i] = CacheManager._codec.loads(serialized)
+            hits += 1
+
+        CACHE_OPERATIONS.labels("redis", "hit").inc(hits)
+        CACHE_OPERATIONS.labels("redis", "miss").inc(misses)
+        CACHE_OPERATIONS.labels("redis", "error").inc(errors)
+        return values
+
+    @staticmethod
+    async def store_many(values: dict, timeout: int = None, invalidate: bool = True) -> bool:
+        """store many keys in one pipelined round trip. `invalidate` as for `store`"""
+        if not values:
+            return False
+        if timeout is None:
+            timeout = CacheManager._default_timeout
+        try:
+            async with CacheManager._client.pipeline(transaction=False) as pipe:
+                for key, value in values.items():
+                    serialized = CacheManager._codec.dumps(value)
+                    pipe.setex(key, timeout, CacheManager._codec.seal(serialized))
+                    if CacheManager._l1 is not None:
+                        CacheManager._l1.set(key, serialized, len(serialized), timeout)
+                stored = await pipe.execute()
+
+            if CacheManager._l1 is not None and invalidate:
+                await CacheManager._publish_invalidation(*values.keys())
+            return all(stored)
+        except ConnectionError:
+            return False
+
+    # single-flight loading
+    @staticmethod
+    async def fetch_or_load(key: str, loader: Callable[[], Awaitable[Any]], timeout: int = None) -> Any:
+        """
+        fetch a key, or load it with `loader` & store it when missing. concurrent callers in a worker share one load,
+        across workers a redis lock lets one of them load while the others wait for the value. values are refreshed
+        early with a probability growing as they near expiry (xfetch) so hot keys rarely expire under load.
+        values are stored wrapped with their load time, so keys used here should only be read through here.
+        the returned value is shared by all concurrent callers and must not be mutated.
+        """
+        task = CacheManager._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(CacheManager._fetch_or_load(key, loader, timeout))
+            CacheManager._inflight[key] = task
+            task.add_done_callback(lambda _: CacheManager._inflight.pop(key, None))
+
+        # shielded, so a caller going away doesn't cancel the load for the others
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _fetch_or_load(key: str, loader: Callable[[], Awaitable[Any]], timeout: int = None) -> Any:
+        if CacheManager._l1 is not None:
+            serialized = CacheManager._l1.get(key)
+            if serialized is not None:
+                CACHE_OPERATIONS.labels("l1", "hit").inc()
+                return CacheManager._codec.loads(serialized)["v"]
+            CACHE_OPERATIONS.labels("l1", "miss").inc()
+
+        try:
+            async with CacheManager._client.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.pttl(key)
+                value, ttl = await pipe.execute()
+        except ConnectionError:
+            CACHE_OPERATIONS.labels("redis", "error").inc()
+            return await loader()
+
+        try:
+            serialized = CacheManager._codec.unseal(value) if value else None
+        except CacheCodecError:
+            CACHE_OPERATIONS.labels("redis", "error").inc()
+            serialized = None
+        else:
+            CACHE_OPERATIONS.labels("redis", "hit" if serialized else "miss").inc()
+
+        if serialized:
+            if CacheManager._l1 is not None:
+                CacheManager._l1.set(key, serialized, len(serialized))
+
+            envelope = CacheManager._codec.loads(serialized)
+            delta, remaining = envelope["d"], ttl / 1000
+            if remaining > 0 and delta * CacheManager._refresh_beta * -math.log(1 - random.random()) < remaining:
+                return envelope["v"]
+
+            # time for an early refresh, which only the lock holder does. the others keep serving the value
+            if not await CacheManager._acquire_lock(key):
+                return envelope["v"]
+            return await CacheManager._load_and_store(key, loader, timeout)
+
+        if await CacheManager._acquire_lock(key):
+            return await CacheManager._load_and_store(key, loader, timeout)
+
+        # another worker is loading, wait for it to fill the key. load here if it doesn't in time
+        deadline = time.monotonic() + CacheManager._lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            try:
+                value = await CacheManager._client.get(key)
+            except ConnectionError:
+                break
+            if value:
+                try:
+                    return CacheManager._codec.loads(CacheManager._codec.unseal(value))["v"]
+                except CacheCodecError:
+                    break
+        return await loader()
+
+    @staticmethod
+    async def _load_and_store(key: str, loader: Callable[[], Awaitable[Any]], timeout: int = None) -> Any:
+        stored = False
+        try:
+            started = time.perf_counter()
+            value = await loader()
+            if value:
+                stored = await CacheManager.store(
+                    key, {"v": value, "d": time.perf_counter() - started}, timeout, invalidate=False
+                )
+            return value
+        finally:
+            # a stored value releases the waiters, the lock is left to expire so that no other worker refreshes
+            # it right away. if nothing was stored, release it so the waiters don't wait for nothing
+            if not stored:
+                await CacheManager._release_lock(key)
+
+    @staticmethod
+    async def _acquire_lock(key: str) -> bool:
+        try:
+            return bool(
+                await CacheManager._client.set(
+                    f"(lock)({key})", CacheManager._origin, nx=True, px=int(CacheManager._lock_timeout * 1000)
+                )
+            )
+        except ConnectionError:
+            return True
+
+    @staticmethod
+    async def _release_lock(key: str):
+        try:
+            await CacheManager._client.delete(f"(lock)({key})")
+        except ConnectionError:
+            pass
+
+    # generation counters. keys built with the current generation go stale as soon as it is bumped
+    # and are left to expire, so invalidating a whole namespace is a single INCR instead of a SCAN
+    @staticmethod
+    def _generation_key(namespace: str) -> str:
+        return f"({namespace})(gen)"
+
+    @staticmethod
+    async def get_generation(namespace: str) -> int:
+        try:
+            generation = await CacheManager._client.get(CacheManager._generation_key(namespace))
+            return int(generation) if generation else 0
+        except ConnectionError:
+            return 0
+
+    @staticmethod
+    async def bump_generation(namespace: str) -> int:
+        try:
+            return await CacheManager._client.incr(CacheManager._generation_key(namespace))
+        except ConnectionError:
+            return 0
+
+    # l1 invalidation
+    @staticmethod
+    async def _publish_invalidation(*keys: str, pattern: bool = False):
+        message = json.dumps({"origin": CacheManager._origin, "keys": keys, "pattern": pattern})
+        await CacheManager._client.publish(CacheManager._invalidation_channel, message)
+
+    @classmethod
+    async def _listen_for_invalidations(cls):
+        # runs for the worker's lifetime: any failure clears the local caches (invalidations may have been missed)
+        # & resubscribes after a pause, a malformed message is skipped
+        while cls._invalidation_listener is not None:
+            pubsub = cls._client.pubsub()
+            try:
+                await pubsub.subscribe(cls._invalidation_channel)
+                # anything cached while we were not listening may be stale
+                cls._clear_local_caches()
+
+                while cls._invalidation_listener is not None:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None:
+                        continue
+                    cls._apply_invalidation(message["data"])
+            except Exception:
+                logger.warning("cache invalidation listener failed, resubscribing", exc_info=True)
+                cls._clear_local_caches()
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+    @classmethod
+    def _apply_invalidation(cls, raw: bytes):
+        try:
+            data = json.loads(raw)
+            if data.get("origin") == cls._origin:
+                return None
+            keys = [key for key in data.get("keys", ()) if isinstance(key, str)]
+            pattern = bool(data.get("pattern", False))
+        except (ValueError, TypeError, AttributeError):
+            logger.warning(f"skipping malformed cache invalidation: {raw!r:.200}")
+            return None
+
+        for key in keys:
+            for cache in cls._local_caches:
+                cache.invalidate(key, pattern=pattern)
+
+    @classmethod
+    def _clear_local_caches(cls):
+        for cache in cls._local_caches:
+            cache.clear()
+
+    @classmethod
+    def start_invalidation_listener(cls):
+        if not cls._local_caches or cls._invalidation_listener is not None:
+            return None
+
+        cls._invalidation_listener = asyncio.create_task(cls._listen_for_invalidations())
+
+    @classmethod
+    async def stop_invalidation_listener(cls):
+        if cls._invalidation_listener is None:
+            return None
+
+        # the listener polls with a short timeout & stops once it's unset, cancel it if it doesn't in time
+        listener, cls._invalidation_listener = cls._invalidation_listener, None
+        try:
+            await asyncio.wait_for(listener, timeout=5)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+
+    @staticmethod
+    def stats() -> dict:
+        return {"l1": CacheManager._l1.stats() if CacheManager._l1 is not None else None}
@@ -0,0 +1,124 @@
+import os
+import zlib
+from abc import ABC, abstractmethod
+from base64 import urlsafe_b64decode
+from typing import Any
+
+import orjson
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+class CacheCodecError(ValueError):
+    """raised when a cache value can't be decoded (corrupt, tampered or written with another key)"""
+
+
+class CacheCodec(ABC):
+    """
+    base class for cache codecs. values go through two steps each way:
+    dumps/loads (value <-> plain bytes, what the in-process l1 tier keeps) and seal/unseal (plain bytes <-> what's in redis)
+    """
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    def loads(self, serialized: bytes) -> Any:
+        # json in, so reads values written by any codec version
+        return orjson.loads(serialized)
+
+    @abstractmethod
+    def seal(self, serialized: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def unseal(self, payload: bytes) -> bytes:
+        ...
+
+
+class FernetCodec(CacheCodec):
+    """v1 (legacy): json encrypted as a base64 fernet token"""
+
+    def __init__(self, crypto_key: str) -> None:
+        self._cipher = Fernet(crypto_key.encode("utf-8"))
+
+    def seal(self, serialized: bytes) -> bytes:
+        return self._cipher.encrypt(serialized)
+
+    def unseal(self, payload: bytes) -> bytes:
+        try:
+            return self._cipher.decrypt(payload)
+        except InvalidToken:
+            raise CacheCodecError("invalid fernet token")
+
+
+class BinaryCodec(CacheCodec):
+    """
+    v2: version byte, flags byte, 12 byte nonce, then aes-256-gcm over the (optionally zlib compressed) json.
+    raw bytes, no base64. the aes key is derived from the cache crypto key with hkdf
+    """
+
+    VERSION = b"\x02"
+    FLAG_COMPRESSED = 0x01
+
+    def __init__(self, crypto_key: str, compress_threshold: int = 1024) -> None:
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"jiroapi-cache-codec-v2").derive(
+            urlsafe_b64decode(crypto_key.encode("utf-8"))
+        )
+        self._cipher = AESGCM(key)
+        self._compress_threshold = compress_threshold
+
+    def seal(self, serialized: bytes) -> bytes:
+        flags = 0
+        if self._compress_threshold and len(serialized) > self._compress_threshold:
+            serialized = zlib.compress(serialized)
+            flags |= self.FLAG_COMPRESSED
+
+        header = self.VERSION + bytes([flags])
+        nonce = os.urandom(12)
+        return header + nonce + self._cipher.encrypt(nonce, serialized, header)
+
+    def unseal(self, payload: bytes) -> bytes:
+        header, nonce, ciphertext = payload[:2], payload[2:14], payload[14:]
+        try:
+            serialized = self._cipher.decrypt(nonce, ciphertext, header)
+        except InvalidTag:
+            raise CacheCodecError("invalid v2 payload")
+
+        if header[1] & self.FLAG_COMPRESSED:
+            serialized = zlib.decompress(serialized)
+        return serialized
+
+
+class VersionedCodec(CacheCodec):
+    """writes with one codec, reads whatever version a value was written with (by its first byte)"""
+
+    def __init__(self, writer: CacheCodec, binary: BinaryCodec, legacy: FernetCodec) -> None:
+        self._writer = writer
+        self._binary = binary
+        self._legacy = legacy
+
+    def seal(self, serialized: bytes) -> bytes:
+        return self._writer.seal(serialized)
+
+    def unseal(self, payload: bytes) -> bytes:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        # fernet tokens are base64 text, they never start with the v2 version byte
+        if payload[:1] == BinaryCodec.VERSION:
+            return self._binary.unseal(payload)
+        return self._legacy.unseal(payload)
+
+
+def make_codec(crypto_key: str, name: str = "binary", compress_threshold: int = 1024) -> CacheCodec:
+    """codec writing `name` ("binary" or "fernet") values, able to read both"""
+    binary = BinaryCodec(crypto_key, compress_threshold)
+    legacy = FernetCodec(crypto_key)
+    writers = {"binary": binary, "fernet": legacy}
+    if name not in writers:
+        raise ValueError(f"unknown cache codec: {name}")
+
+    return VersionedCodec(writer=writers[name], binary=binary, legacy=legacy)
@@ -1,7 +1,11 @@
+import asyncio
 from abc import ABC
+from typing import Dict, List, Tuple
 
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ServerSelectionTimeoutError
+from fastapi.logger import logger
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
 
 
 class DatabaseManager(ABC):
@@ -10,6 +14,19 @@ class DatabaseManager(ABC):
     _initialized = False
     _client = None
 
+    # declared by subclasses: the database & collection they work on, the indexes it needs
+    # and a sample of each query they run ({name: (filter, sort)}) for plan reports
+    db_name: str = None
+    collection_name: str = None
+    indexes: List[IndexModel] = []
+    queries: Dict[str, Tuple[dict, list]] = {}
+
+    _managers = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        DatabaseManager._managers.append(cls)
+
     @classmethod
     def init(cls, client: AsyncIOMotorClient):
         if cls._initialized:
@@ -18,10 +35,93 @@ class DatabaseManager(ABC):
         cls._initialized = True
         cls._client = client
 
+    @classmethod
+    def connect(cls, uri: str, **options):
+        """
+        build the client & init with it. called from the worker's startup, after gunicorn forked it, so no client
+        (and none of its threads or sockets) is ever created in the master. a no-op if already initialized
+        """
+        if cls._initialized:
+            return None
+
+        cls.init(client=AsyncIOMotorClient(uri, **options))
+
     @staticmethod
-    def ping() -> bool:
+    async def warm_up(connections: int):
+        """open `connections` pooled connections up front, so the first requests don't pay for the handshakes"""
+        if connections <= 0:
+            return None
         try:
-            _ = DatabaseManager._client.address
+            _ = await asyncio.gather(*(DatabaseManager._client.admin.command("ping") for _ in range(connections)))
+        except PyMongoError:
+            logger.warning("unable to warm up the database connection pool", exc_info=True)
+
+    @classmethod
+    def close(cls):
+        if cls._client is not None:
+            cls._client.close()
+        cls._client = None
+        cls._initialized = False
+
+    @property
+    def collection(self) -> AsyncIOMotorCollection:
+        # resolved on first use rather than when the manager is created (at import, before the client exists)
+        collection = self.__dict__.get("_collection")
+        if collection is None or collection.database.client is not DatabaseManager._client:
+            collection = self._collection = DatabaseManager._client[self.db_name][self.collection_name]
+        return collection
+
+    @staticmethod
+    async def ping(timeout: float) -> bool:
+        # a round trip rather than the client's (blocking) topology lookup, bounded so it never waits for server
+        # selection to time out
+        try:
+            _ = await asyncio.wait_for(DatabaseManager._client.admin.command("ping"), timeout=timeout)
             return True
-        except ServerSelectionTimeoutError:
+        except (PyMongoError, asyncio.TimeoutError):
             return False
+
+    @staticmethod
+    async def ensure_indexes(db_name: str):
+        """create every declared index. a no-op for indexes that already exist, so safe to run from every worker"""
+        for manager in DatabaseManager._managers:
+            if not manager.indexes:
+                continue
+
+            collection = DatabaseManager._client[db_name][manager.collection_name]
+            try:
+                _ = await collection.create_indexes(manager.indexes)
+            except PyMongoError:
+                logger.error(f"unable to create indexes for {manager.__name__} on {manager.collection_name}", exc_info=True)
+
+    @staticmethod
+    async def explain_queries(db_name: str) -> List[dict]:
+        """explain every declared query and flag the ones planned as collection scans"""
+
+        def _stages(plan: dict) -> List[str]:
+            stages = [plan.get("stage")]
+            for child in plan.get("inputStages", []) + [plan.get("inputStage")]:
+                if child:
+                    stages.extend(_stages(child))
+            return stages
+
+        report = []
+        for manager in DatabaseManager._managers:
+            collection = DatabaseManager._client[db_name][manager.collection_name]
+            for name, (query, sort) in manager.queries.items():
+                cursor = collection.find(query)
+                if sort:
+                    cursor = cursor.sort(sort)
+
+                plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+                stages = _stages(plan)
+                report.append(
+                    {
+                        "manager": manager.__name__,
+                        "query": name,
+                        "collection": manager.collection_name,
+                        "stages": stages,
+                        "collscan": "COLLSCAN" in stages,
+                    }
+                )
+        return report
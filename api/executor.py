@@ -0,0 +1,178 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
+
+from telemetry import (
+    CRYPTO_EXECUTOR_QUEUE_DEPTH,
+    CRYPTO_EXECUTOR_REJECTED,
+    CRYPTO_EXECUTOR_WAIT,
+    CRYPTO_LATENCY,
+)
+
+
+def _ready() -> bool:
+    return True
+
+
+def _init_process(parent: int):
+    # pool processes are forked from a uvicorn worker: drop the signal handlers inherited from it (they'd make
+    # the process ignore SIGINT/SIGTERM), and exit with the worker even when it is killed without a clean shutdown
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_DFL)
+    threading.Thread(target=_exit_with_parent, args=(parent,), daemon=True).start()
+
+
+def _exit_with_parent(parent: int):
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+class CryptoExecutorBusy(RuntimeError):
+    """raised when the crypto executor can't take more work"""
+
+
+class CryptoExecutor:
+    """bounded process pool to run cpu heavy crypto (bcrypt, kdf) off the event loop"""
+
+    _initialized = False
+    _pool = None
+    _max_workers = None
+    _max_queue = None
+    _queue_timeout = None
+    _slots = None
+
+    # metrics
+    _queued = 0
+    _running = 0
+    _submitted = 0
+    _rejected = 0
+    _wait_time_total = 0.0
+    _wait_time_max = 0.0
+
+    @classmethod
+    def init(cls, max_workers: int, max_queue: int, queue_timeout: float):
+        if cls._initialized:
+            return None
+
+        cls._initialized = True
+        cls._max_workers = max_workers
+        cls._max_queue = max_queue
+        cls._queue_timeout = queue_timeout
+
+    @classmethod
+    def _get_pool(cls) -> ProcessPoolExecutor:
+        # created lazily so the pool is forked from the worker, not the gunicorn master
+        if cls._pool is None:
+            cls._pool = ProcessPoolExecutor(
+                max_workers=cls._max_workers, initializer=_init_process, initargs=(os.getpid(),)
+            )
+            cls._slots = asyncio.Semaphore(cls._max_workers)
+        return cls._pool
+
+    @classmethod
+    async def warm_up(cls):
+        """start the pool's processes up front, so the first logins don't wait for them"""
+        pool = cls._get_pool()
+        loop = asyncio.get_running_loop()
+        _ = await asyncio.gather(*(loop.run_in_executor(pool, _ready) for _ in range(cls._max_workers)))
+
+    @classmethod
+    async def run(cls, func: Callable, *args, exempt: bool = False) -> Any:
+        """
+        run `func` in the pool. `exempt` calls are never rejected: they wait for a process however long the queue,
+        for work that can't be retried by a client (e.g. done after the response was sent)
+        """
+        pool = cls._get_pool()
+
+        # back-pressure: only as many calls as there are processes are handed to the pool,
+        # the rest wait here and are rejected once the queue is full or they waited too long
+        if not exempt and cls._queued >= cls._max_queue:
+            cls._rejected += 1
+            CRYPTO_EXECUTOR_REJECTED.inc()
+            raise CryptoExecutorBusy("crypto executor queue is full")
+
+        cls._queued += 1
+        CRYPTO_EXECUTOR_QUEUE_DEPTH.inc()
+        enqueued = time.perf_counter()
+        try:
+            if not await cls._acquire_slot(None if exempt else cls._queue_timeout):
+                cls._rejected += 1
+                CRYPTO_EXECUTOR_REJECTED.inc()
+                raise CryptoExecutorBusy("timed out waiting for crypto executor")
+        finally:
+            cls._queued -= 1
+            CRYPTO_EXECUTOR_QUEUE_DEPTH.dec()
+
+        try:
+            cls._record_wait(enqueued)
+            cls._submitted += 1
+            cls._running += 1
+            # timed here rather than in the pool processes, which don't report metrics
+            started = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+            finally:
+                CRYPTO_LATENCY.labels(func.__name__).observe(time.perf_counter() - started)
+        finally:
+            cls._running -= 1
+            cls._slots.release()
+
+    @classmethod
+    async def _acquire_slot(cls, timeout: float = None) -> bool:
+        """
+        wait up to `timeout` for a pool slot. False when none came in time. unlike wait_for, an acquire that
+        completes as the timeout fires (or as the caller is cancelled) gives its slot back instead of leaking it
+        """
+        acquire = asyncio.ensure_future(cls._slots.acquire())
+        try:
+            done, _ = await asyncio.wait({acquire}, timeout=timeout)
+        except asyncio.CancelledError:
+            cls._abandon_slot(acquire)
+            raise
+        if not done:
+            cls._abandon_slot(acquire)
+            return False
+        return True
+
+    @classmethod
+    def _abandon_slot(cls, acquire: asyncio.Future):
+        def __release(acquire: asyncio.Future):
+            if not acquire.cancelled() and acquire.exception() is None:
+                cls._slots.release()
+
+        if acquire.done():
+            __release(acquire)
+        else:
+            acquire.cancel()
+            acquire.add_done_callback(__release)
+
+    @classmethod
+    def _record_wait(cls, enqueued: float):
+        waited = time.perf_counter() - enqueued
+        CRYPTO_EXECUTOR_WAIT.observe(waited)
+        cls._wait_time_total += waited
+        cls._wait_time_max = max(cls._wait_time_max, waited)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "max_workers": cls._max_workers,
+            "max_queue": cls._max_queue,
+            "queue_depth": cls._queued,
+            "running": cls._running,
+            "submitted": cls._submitted,
+            "rejected": cls._rejected,
+            "wait_time_avg": cls._wait_time_total / cls._submitted if cls._submitted else 0.0,
+            "wait_time_max": cls._wait_time_max,
+        }
+
+    @classmethod
+    def shutdown(cls):
+        if cls._pool is not None:
+            cls._pool.shutdown(wait=True)
+            cls._pool = None
@@ -1,13 +1,79 @@
+import math
 import os
+import time
 
 from config import config as app_config
+from worker import rss_bytes
 
 # log everything to console
 accesslog = "-"
 errorlog = "-"
 
+
+def cpu_limit() -> float:
+    """cpus this container may use: its cgroup cpu quota if it has one, else the cpus the process can run on"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    try:
+        # cgroup v2, "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        quota = -1 if quota == "max" else int(quota)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1, quota is -1 when unlimited
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as g:
+                quota, period = int(f.read()), g.read()
+        except (OSError, ValueError):
+            quota = -1
+
+    if quota > 0:
+        return min(cpus, quota / int(period))
+    return cpus
+
+
 # other gunicorn configs
 bind = f"0.0.0.0:{app_config.PORT}"
-workers = os.cpu_count()
-threads = os.cpu_count() * 4
 worker_class = "worker.Worker"
+
+# one async worker per cpu: a uvicorn worker runs a single event loop on one core, more of them only contend
+# (see "Worker Sizing" in the README). gunicorn's `threads` does nothing for uvicorn workers, so it isn't set
+workers = app_config.WORKERS or max(1, math.ceil(cpu_limit()))
+
+# recycle workers after a number of requests to contain memory growth. the jitter spreads the restarts
+max_requests = app_config.MAX_REQUESTS
+max_requests_jitter = app_config.MAX_REQUESTS_JITTER
+
+# import the app once in the master, workers share its memory copy-on-write & boot faster.
+# safe since no client is created at import, each worker connects in its startup hooks
+preload_app = True
+
+# metrics. workers write their prometheus metrics to files in this folder so /metrics reports for all of them.
+# set up here, when the config is read & before the preloaded app imports prometheus_client.
+# metrics left over from a previous run would be summed with the new ones, so the folder starts empty
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/jiroapi-metrics")
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+for name in os.listdir(os.environ["PROMETHEUS_MULTIPROC_DIR"]):
+    os.remove(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], name))
+
+
+# per-worker resource reporting. readiness (startup time & rss once serving) is logged by the worker itself
+def when_ready(server):
+    server.log.info(f"{server.num_workers} workers (cpu limit {cpu_limit():g}), master rss {rss_bytes() >> 20} MB")
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def worker_exit(server, worker):
+    uptime = time.monotonic() - getattr(worker, "forked_at", time.monotonic())
+    server.log.info(
+        f"worker {worker.pid} exiting after {uptime:.0f}s, {worker.requests_served} requests served, "
+        f"rss {rss_bytes() >> 20} MB"
+    )
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
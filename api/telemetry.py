@@ -0,0 +1,168 @@
+import asyncio
+import os
+import time
+from functools import wraps
+from typing import Callable, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from pymongo import monitoring
+
+# metrics. when PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) each worker writes its own files
+# and the /metrics route aggregates them, so whichever worker answers reports for all of them
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "time to last response byte, per route",
+    ["method", "route", "status"],
+)
+CACHE_OPERATIONS = Counter(
+    "cache_operations_total",
+    "cache lookups by tier & result (hit, miss, error)",
+    ["tier", "result"],
+)
+MONGODB_COMMAND_LATENCY = Histogram(
+    "mongodb_command_duration_seconds",
+    "mongodb command round trip time",
+    ["command", "status"],
+)
+CRYPTO_LATENCY = Histogram(
+    "crypto_operation_duration_seconds",
+    "bcrypt & fernet operation time",
+    ["operation"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+CRYPTO_EXECUTOR_QUEUE_DEPTH = Gauge(
+    "crypto_executor_queue_depth",
+    "calls waiting for a crypto process",
+    multiprocess_mode="livesum",
+)
+CRYPTO_EXECUTOR_WAIT = Histogram(
+    "crypto_executor_wait_seconds",
+    "time calls waited for a crypto process",
+)
+CRYPTO_EXECUTOR_REJECTED = Counter(
+    "crypto_executor_rejected_total",
+    "calls rejected because the crypto executor was busy",
+)
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "how late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def timed(histogram: Histogram, *labels: str) -> Callable:
+    """decorator observing a function's run time"""
+
+    def decorator(func: Callable) -> Callable:
+        metric = histogram.labels(*labels)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo command listener observing each command's round trip"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGODB_COMMAND_LATENCY.labels(event.command_name, "success").observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGODB_COMMAND_LATENCY.labels(event.command_name, "failure").observe(event.duration_micros / 1e6)
+
+
+class RequestTimerMiddleware:
+    """asgi middleware observing request latency per route template (not per raw path)"""
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self._routes = None
+
+    def _route(self, scope: dict) -> str:
+        if self._routes is None:
+            self._routes = {route.endpoint: route.path for route in scope["app"].routes}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status_code = 500
+        observed = False
+
+        def __observe():
+            nonlocal observed
+            if not observed:
+                observed = True
+                REQUEST_LATENCY.labels(scope["method"], self._route(scope), status_code).observe(
+                    time.perf_counter() - started
+                )
+
+        async def __send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            # background tasks run after the last body chunk, they don't count towards latency
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                __observe()
+
+        try:
+            await self.app(scope, receive, __send)
+        finally:
+            __observe()
+
+
+# event loop lag
+_event_loop_monitor = None
+
+
+async def _monitor_event_loop_lag(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+def start_event_loop_monitor(interval: float = 0.5):
+    global _event_loop_monitor
+    if _event_loop_monitor is None:
+        _event_loop_monitor = asyncio.ensure_future(_monitor_event_loop_lag(interval))
+
+
+def stop_event_loop_monitor():
+    global _event_loop_monitor
+    if _event_loop_monitor is not None:
+        _event_loop_monitor.cancel()
+        _event_loop_monitor = None
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
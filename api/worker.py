@@ -1,6 +1,57 @@
+import os
+import resource
+import sys
+import time
+
+from gunicorn.arbiter import Arbiter
+from uvicorn.main import Server
 from uvicorn.workers import UvicornWorker
 
+
+def rss_bytes(pid: int = None) -> int:
+    """resident memory of a process (this one by default)"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # no procfs, fall back to this process' peak rss
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ReportingServer(Server):
+    """uvicorn server calling back once it serves, i.e. after the app's startup hooks ran"""
+
+    def __init__(self, config, on_started) -> None:
+        super().__init__(config=config)
+        self.on_started = on_started
+
+    async def startup(self, sockets: list = None) -> None:
+        await super().startup(sockets=sockets)
+        if self.started:
+            self.on_started()
+
+
 class Worker(UvicornWorker):
     CONFIG_KWARGS = {
         "root_path": "/api/v1"
     }
+
+    server = None
+
+    @property
+    def requests_served(self) -> int:
+        return self.server.server_state.total_requests if self.server is not None else 0
+
+    async def _serve(self) -> None:
+        self.config.app = self.wsgi
+        self.server = ReportingServer(config=self.config, on_started=self._report_ready)
+        await self.server.serve(sockets=self.sockets)
+        if not self.server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+    def _report_ready(self):
+        startup = time.monotonic() - getattr(self, "forked_at", time.monotonic())
+        self.log.info(
+            f"worker {self.pid} ready in {startup:.2f}s, rss {rss_bytes() >> 20} MB, "
+            f"recycled after {self.max_requests} requests"
+        )